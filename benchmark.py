@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""
+benchmark.py [<options>] [name]*
+
+Description: Benchmarks for harmonize.py.
+
+Runs a fixed set of benchmarks over a fixed corpus of melodies: the
+default C D E D C, the D A B A G F# E D example from the profiling
+notes in harmonize.py, and long synthetic melodies.  For each
+benchmark it records the best time per call, the number of results
+(so that a change that speeds things up by getting the answer wrong
+shows up), and the peak memory use.
+
+Each benchmark runs in a child process of its own, so the caches in
+harmonize.py start out empty and the peak memory belongs to that
+benchmark alone.  The synthetic melodies have far too many
+harmonizations to list, so for them only the lattice is built.
+
+Only the benchmarks whose names contain one of the names given on
+the command line are run (all of them, if there are none).
+
+  python benchmark.py --save baseline.json
+  python benchmark.py --compare baseline.json --threshold 0.2
+
+"""
+#
+# Imports
+#
+from __future__ import division, absolute_import, with_statement
+from optparse        import OptionParser
+from random          import Random
+from timeit          import default_timer
+from multiprocessing import Process, Queue
+from Queue           import Empty
+import json
+import platform
+import sys
+import traceback
+
+try:
+    import resource
+except ImportError:
+    # resource is only needed to measure memory use
+    resource = None
+
+import harmonize as hm
+
+##################################################################
+
+def synthetic_melody(length, seed=0):
+    """
+    Return a melody of length notes that wanders up and down the C
+    major scale, mostly by step, and ends on C.
+
+    >>> ' '.join(str(n) for n in synthetic_melody(8))
+    'E0 F0 E0 D0 E0 D0 E0 C0'
+    """
+    rng = Random(seed)
+    scale = [hm.Note.of(name) for name in 'CDEFGAB'] + [hm.Note.of('C', 0, 1)]
+    position = 0
+    melody = []
+    for i in range(length - 1):
+        position += rng.choice((-2, -1, -1, 1, 1, 2))
+        position = min(max(position, 0), len(scale) - 1)
+        melody.append(scale[position])
+    melody.append(scale[0])
+    return tuple(melody)
+
+def _parse(notes):
+    return tuple(hm.Note(n) for n in notes.split())
+
+# Melodies short enough to list every harmonization of
+SHORT_MELODIES = [('CDEDC', _parse('C D E D C')),
+                  ('DABAGF#ED', _parse("D A B A G F# E D"))]
+
+# Melodies that are only counted
+LONG_MELODIES = [('synthetic%d' % length, synthetic_melody(length))
+                 for length in (16, 32, 64)]
+
+##################################################################
+
+def bench_harmonize(melody):
+    return len(hm.harmonize(melody, use_cache=False))
+
+def bench_harmonize_cached(melody):
+    return len(hm.harmonize(melody))
+
+def bench_get_harmonizations(melody):
+    harmonizations = [[hm.Cmaj + melody[-1]]]
+    for i in range(len(melody) - 1):
+        harmonizations = hm.fill_harmonizations(harmonizations, melody)
+    return len(harmonizations)
+
+def bench_lattice(melody):
+    return hm.HarmonizationLattice(melody).count
+
+# Every spelling of every note in two octaves
+ARITHMETIC_NOTES = [hm.Note(name=name, accidental=accidental, octave=octave)
+                    for name in 'CDEFGAB'
+                    for accidental in (-1, 0, 1)
+                    for octave in (0, 1)]
+
+def bench_note_arithmetic():
+    count = 0
+    for a in ARITHMETIC_NOTES:
+        for b in ARITHMETIC_NOTES:
+            a + b
+            a - b
+            count += 2
+    return count
+
+CHORD_SHORTHANDS = [name + accidental + '0' + quality
+                    for name in 'CDEFGAB'
+                    for accidental in ('b', '', '#')
+                    for quality in ('maj', 'min', 'dim', 'aug')]
+
+def bench_chord_construction():
+    for short in CHORD_SHORTHANDS:
+        hm.Chord(short)
+    return len(CHORD_SHORTHANDS)
+
+def benchmarks():
+    """
+    Return the list of (name, function, args) benchmarks.
+    """
+    result = []
+    for (name, melody) in SHORT_MELODIES:
+        result.append(('harmonize/' + name, bench_harmonize, (melody,)))
+        result.append(('harmonize-cached/' + name, bench_harmonize_cached,
+                       (melody,)))
+        result.append(('get_harmonizations/' + name, bench_get_harmonizations,
+                       (melody,)))
+    for (name, melody) in SHORT_MELODIES + LONG_MELODIES:
+        result.append(('lattice/' + name, bench_lattice, (melody,)))
+    result.append(('note-arithmetic', bench_note_arithmetic, ()))
+    result.append(('chord-construction', bench_chord_construction, ()))
+    return result
+
+##################################################################
+
+def time_call(function, args, repeat=5, min_time=0.2):
+    """
+    Return (seconds, result): the best time per call of function(*args)
+    over repeat rounds, each of which calls it enough times to take
+    at least min_time seconds, and what it returned.
+    """
+    best = None
+    for i in range(repeat):
+        number = 0
+        start = default_timer()
+        while True:
+            result = function(*args)
+            number += 1
+            elapsed = default_timer() - start
+            if elapsed >= min_time:
+                break
+        if best is None or elapsed / number < best:
+            best = elapsed / number
+    return (best, result)
+
+def peak_memory():
+    """
+    Return the peak resident memory of this process, in kilobytes, or
+    None if it can't be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Mac OS X reports bytes
+        peak //= 1024
+    return peak
+
+def _run_child(queue, function, args, repeat, min_time):
+    try:
+        (seconds, count) = time_call(function, args, repeat, min_time)
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+    else:
+        queue.put({'seconds': seconds, 'count': count,
+                   'peak_kb': peak_memory()})
+
+def run_benchmark(function, args, repeat=5, min_time=0.2):
+    """
+    Run one benchmark in a child process, and return a dictionary of
+    its best time per call in seconds, result count, and peak memory
+    in kilobytes.  If the benchmark fails, or the child dies without
+    an answer, the dictionary has an error message instead.
+    """
+    queue = Queue()
+    child = Process(target=_run_child,
+                    args=(queue, function, args, repeat, min_time))
+    child.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not child.is_alive():
+                # The child may have answered just before it exited
+                try:
+                    result = queue.get(timeout=1)
+                except Empty:
+                    result = {'error': 'the benchmark process exited '
+                                       'with code %s' % child.exitcode}
+                break
+    child.join()
+    return result
+
+def run(names=(), repeat=5, min_time=0.2, out=sys.stdout):
+    """
+    Run the benchmarks whose names contain one of names (or all of
+    them), printing a line for each to out, and return the baseline
+    dictionary that --save writes.
+    """
+    results = {}
+    for (name, function, args) in benchmarks():
+        if names and not any(n in name for n in names):
+            continue
+        result = run_benchmark(function, args, repeat, min_time)
+        results[name] = result
+        if 'error' in result:
+            print >> out, "%-32s FAILED\n%s" % (name, result['error'])
+        else:
+            print >> out, "%-32s %12.6f s %12s results %10s KB" % (
+                name, result['seconds'], result['count'], result['peak_kb'])
+    return {'python': platform.python_version(),
+            'machine': platform.machine(),
+            'results': results}
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Return a list of messages, one for each benchmark in both baseline
+    and current that got more than threshold (a fraction) slower or
+    gave a different number of results, and one for each benchmark
+    that failed.
+    """
+    problems = []
+    for (name, new) in sorted(current['results'].iteritems()):
+        if 'error' in new:
+            problems.append("%s: failed" % name)
+            continue
+        old = baseline['results'].get(name)
+        if old is None or 'error' in old:
+            continue
+        if new['count'] != old['count']:
+            problems.append("%s: %s results, was %s" % (
+                name, new['count'], old['count']))
+        change = new['seconds'] / old['seconds'] - 1
+        if change > threshold:
+            problems.append("%s: %.6f s, was %.6f s (%+.0f%%)" % (
+                name, new['seconds'], old['seconds'], 100 * change))
+    return problems
+
+##################################################################
+
+def main():
+    """
+    Main body of the script.
+    """
+    opts,args = getopts()
+    if opts.doctest:
+        import doctest
+        doctest.testmod(verbose=opts.verbose)
+        return
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)
+    current = run(args, repeat=opts.repeat, min_time=opts.min_time)
+    if opts.save:
+        with open(opts.save, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if opts.compare:
+        problems = compare(baseline, current, opts.threshold)
+        for problem in problems:
+            print "REGRESSION", problem
+        if problems:
+            sys.exit(1)
+    if any('error' in result for result in current['results'].itervalues()):
+        sys.exit(1)
+
+def getopts():
+    """
+    Parse the command-line options
+    """
+    parser = OptionParser(usage=__doc__.strip().splitlines()[0])
+    parser.add_option('--save', metavar='FILE',
+                      help='save the results as a JSON baseline')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the results with a saved baseline, and '
+                           'exit with status 1 if any regressed')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='how much slower (as a fraction) counts as a '
+                           'regression [default: %default]')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='time each benchmark this many times, and keep '
+                           'the best [default: %default]')
+    parser.add_option('--min-time', type='float', default=0.2,
+                      help='the least number of seconds for each timing '
+                           '[default: %default]')
+    parser.add_option('--doctest', '--test',
+                      action='store_true',
+                      help='run the doctest')
+    parser.add_option('--verbose', '-v',
+                      action='store_true',
+                      help='verbose')
+    opts,args = parser.parse_args()
+    return (opts,args)
+
+##################################################################
+
+if __name__ == "__main__":
+    main()
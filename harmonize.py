@@ -28,8 +28,8 @@ Intervals.
 
 Wishlist: 
  - add comments
- - add probabilities for transitioning to a chord and a key
- - fit those probabilities (bach chorales are available from music21 project)
+ - add probabilities for transitioning to a key
+ - fit the progression weights (bach chorales are available from music21 project)
 
 Created by: Conan Yuan (yuanc), 20111218
 
@@ -39,13 +39,43 @@ Created by: Conan Yuan (yuanc), 20111218
 #
 
 from __future__ import division, absolute_import, with_statement
-from logging    import debug, getLogger, getLevelName
+from logging    import debug, getLogger, getLevelName, DEBUG
 from optparse   import OptionParser
-from math       import floor
+from math       import floor, log
+from heapq      import nlargest
+from operator   import itemgetter
+from itertools  import islice
+from random     import Random
+from sys        import maxsize, stdin, stdout, stderr
 from functools  import update_wrapper 
 from contextlib import contextmanager
+from collections import OrderedDict
+from weakref    import WeakValueDictionary
+from threading  import Lock
+from hashlib    import sha1
+from array      import array
+from time       import time
+import json
 import re
 
+try:
+    import numpy
+except ImportError:
+    # numpy is only needed for viterbi_harmonize
+    numpy = None
+
+try:
+    import sqlite3
+except ImportError:
+    # sqlite3 is only needed for HarmonizationStore
+    sqlite3 = None
+
+try:
+    import resource
+except ImportError:
+    # resource is only needed to report memory use with --profile
+    resource = None
+
 ##################################################################
 
 def logat(level=None):
@@ -173,18 +203,26 @@ class FrozenClass(object):
     initialized.
 
     The _unfrozen method is also provided, to allow exceptions.  
+
+    FrozenClass uses __slots__, so subclasses that also define
+    __slots__ don't get a per-instance __dict__.  Those subclasses can
+    fill in their slots with object.__setattr__ before freezing, which
+    skips the check in __setattr__.
     '''
 
-    # This controls whether setting attributes is allowed.  
-    __is_frozen = False
+    # __is_frozen controls whether setting attributes is allowed.  It
+    # is unset, which counts as False, until _freeze is called.
+    __slots__ = ('__is_frozen', '__weakref__')
 
+    def _is_frozen(self):
+        return getattr(self, '_FrozenClass__is_frozen', False)
 
     def __setattr__(self, key, value):
         '''
         We allow attributes to be set if and only if the object is not
         frozen.
         '''
-        if self.__is_frozen:
+        if self._is_frozen():
             raise TypeError( "%r is a frozen class" % self )
         object.__setattr__(self, key, value)
 
@@ -193,15 +231,15 @@ class FrozenClass(object):
         We allow attributes to be deleted if and only if the object is
         not frozen.
         '''
-        if self.__is_frozen:
+        if self._is_frozen():
             raise TypeError( "%r is a frozen class" % self )
-        del self.__dict__[k]
+        object.__delattr__(self, k)
 
     def _freeze(self):
         '''
         Call _freeze to disallow further attribute updates.  
         '''
-        self.__is_frozen = True
+        object.__setattr__(self, '_FrozenClass__is_frozen', True)
 
     @contextmanager
     def _unfrozen(self):
@@ -209,14 +247,14 @@ class FrozenClass(object):
         Context manager that temporarily allows adding new attributes inside
         the context.
         """
-        old_frozen = self.__is_frozen
+        old_frozen = self._is_frozen()
         try:
-            # We have to access __dict__ directly in order to bypass
-            # the restrictions in the __setattr__ method.
-            self.__dict__['_FrozenClass__is_frozen'] = False
+            # We have to use object.__setattr__ directly in order to
+            # bypass the restrictions in our __setattr__ method.
+            object.__setattr__(self, '_FrozenClass__is_frozen', False)
             yield
         finally:
-            self.__dict__['_FrozenClass__is_frozen'] = old_frozen
+            object.__setattr__(self, '_FrozenClass__is_frozen', old_frozen)
 
 ##################################################################
 
@@ -224,6 +262,10 @@ class cached_attribute(object):
     """
     Cached attribute access for instances (Based on ActiveState recipe
     276643).  cached_attribute knows how to work with FrozenClass.  
+
+    Instances without a __dict__ (because their class defines
+    __slots__) keep the value in a slot named after the attribute with
+    a leading underscore, so a cached attribute "a" needs a slot "_a".
     
     http://code.activestate.com/recipes/276643-caching-and-aliasing-with-descriptors/history/1/
 
@@ -254,11 +296,19 @@ class cached_attribute(object):
     def __init__(self, method, name=None):
         self.method = method
         self.name   = name or method.__name__
+        self.slot   = '_' + self.name
         update_wrapper(self, method)
 
     def __get__(self, inst, cls=None):
         if inst is None:
             return self
+        if not hasattr(inst, '__dict__'):
+            try:
+                return getattr(inst, self.slot)
+            except AttributeError:
+                result = self.method(inst)
+                object.__setattr__(inst, self.slot, result)
+                return result
         result = self.method(inst)
         if isinstance(inst, FrozenClass):
             with inst._unfrozen():
@@ -269,6 +319,154 @@ class cached_attribute(object):
 
 ##################################################################
 
+class LRUCache(object):
+    """
+    A mapping that holds at most maxsize entries.  When it is full,
+    adding an entry evicts the least recently used one.  Entries are
+    kept on a circular doubly linked list, so lookups and updates take
+    constant time.
+
+    If getsize is given, getsize(value) is the size of an entry, and
+    maxsize bounds the total size of the entries instead of their
+    number.  An entry bigger than maxsize is not stored at all.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> 'b' in cache, 'a' in cache, len(cache)
+    (False, True, 2)
+    >>> cache = LRUCache(5, getsize=len)
+    >>> cache['a'] = 'xx'
+    >>> cache['b'] = 'yyyy'
+    >>> 'a' in cache, cache.size
+    (False, 4)
+    """
+
+    # Each link is a list of [previous link, next link, key, value, size]
+
+    def __init__(self, maxsize=1000, getsize=None):
+        self.maxsize = maxsize
+        self.getsize = getsize
+        # Every lookup reorders the list, so even reads have to hold
+        # the lock when several threads share the cache.
+        self._lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.size = 0
+            self._links = {}
+            # The root is a sentinel: root[1] is the least recently
+            # used link and root[0] is the most recently used one.
+            self._root = []
+            self._root[:] = [self._root, self._root, None, None, 0]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._links.get(key)
+            if link is None:
+                return default
+            # Move the link to the most recently used end
+            (prev, next_link) = (link[0], link[1])
+            prev[1] = next_link
+            next_link[0] = prev
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            return link[3]
+
+    _MISSING = object()
+
+    def __getitem__(self, key):
+        value = self.get(key, self._MISSING)
+        if value is self._MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if self.getsize is None:
+            size = 1
+        else:
+            size = self.getsize(value)
+        with self._lock:
+            if key in self._links:
+                self._remove(self._links[key])
+            if size > self.maxsize:
+                return
+            root = self._root
+            while self.size + size > self.maxsize:
+                self._remove(root[1])
+            last = root[0]
+            link = [last, root, key, value, size]
+            last[1] = root[0] = link
+            self._links[key] = link
+            self.size += size
+
+    def _remove(self, link):
+        # The caller holds the lock
+        (prev, next_link) = (link[0], link[1])
+        prev[1] = next_link
+        next_link[0] = prev
+        del self._links[link[2]]
+        self.size -= link[4]
+
+##################################################################
+
+# Note arithmetic is memoized, keyed by the spelling ids of the two
+# operands (see Note._spelling_id).  The LRU caches are filled as we
+# go; the tables never evict and are only filled by
+# build_arithmetic_tables.  All of them are emptied when the default
+# isotonic_is_equal changes (see _NoteType).
+_SPELLING_IDS = {}
+_SPELLING_IDS_LOCK = Lock()
+_ADD_CACHE = LRUCache(20000)
+_SUB_CACHE = LRUCache(20000)
+_ADD_TABLE = {}
+_SUB_TABLE = {}
+
+class _NoteType(type):
+    """
+    The metaclass of Note.  Each note keeps its own isotonic_is_equal
+    in a slot, which on the class would hide the default that new
+    notes get.  So on the class, isotonic_is_equal is the default,
+    kept in _isotonic_default, and Note.isotonic_is_equal = False
+    changes it for the notes created after that.
+
+    >>> Note.isotonic_is_equal = False
+    >>> (Note('C#') == Note('Db'), Cs == Db)
+    (False, True)
+    >>> ((C + M3).isotonic_is_equal, (Note('E') - C).isotonic_is_equal)
+    (False, False)
+    >>> Note.isotonic_is_equal = True
+    >>> (Note('C#') == Note('Db'), (C + M3).isotonic_is_equal)
+    (True, True)
+    """
+
+    @property
+    def isotonic_is_equal(cls):
+        return cls._isotonic_default
+
+    @isotonic_is_equal.setter
+    def isotonic_is_equal(cls, value):
+        cls._isotonic_default = value
+        # The memoized arithmetic would give back notes made with the
+        # old default
+        _ADD_CACHE.clear()
+        _SUB_CACHE.clear()
+        _ADD_TABLE.clear()
+        _SUB_TABLE.clear()
+
 class Note(FrozenClass):
     """
     A note has these attributes
@@ -279,10 +477,11 @@ class Note(FrozenClass):
       octave     -  a number indicating which octave we are in.  
                     0 is the octave of middle C
 
-    From those attributes, we can compute these properties, which
-    should be considered implementation details, not formally part of
-    the Note API.  We define them here to make the code easier to
-    read.
+    From those attributes, we compute these properties when the note
+    is created, which should be considered implementation details, not
+    formally part of the Note API.  We store them to make the code
+    easier to read, and so that note arithmetic doesn't have to work
+    them out over and over.
 
       steps      -  number of halfsteps away from middle C.  
 
@@ -297,6 +496,9 @@ class Note(FrozenClass):
                     is the same no matter what key we are in, or you
                     could say that we insist on the key of C.
 
+      pitch_class - steps modulo 12, so notes that sound the same in
+                    any octave have the same pitch class.
+
     The main features of a Note are Note arithmetic, and translation
     to and from a string representation.  The string representation
     simply concatenates the note name ('A' to 'G'), the accidental
@@ -323,15 +525,23 @@ class Note(FrozenClass):
     # Note: Class Attributes
     #
 
-    __is_frozen = False
+    # isotonic_is_equal says whether notes that sound the same but are
+    # spelled differently (C# and Db) compare equal.  It defaults to
+    # Note.isotonic_is_equal (see _NoteType), which is True.
+    # _spelling_id is a small integer that is the same for all
+    # instances of a class with the same name, accidental and octave.
+    __slots__ = ('name', 'accidental', 'octave',
+                 'steps', 'scale_num', 'pitch_class',
+                 'isotonic_is_equal', '_spelling_id')
+
+    __metaclass__ = _NoteType
+    _isotonic_default = True
 
     _NOTE_ORDER = ('C', 'D', 'E', 'F', 'G', 'A', 'B')
     _STEPS_PER_OCTAVE = 12
     _NOTES_PER_OCTAVE = len(_NOTE_ORDER)
     _ACCIDENTAL_SYMS = ('bb', 'b', '', '#', 'x')
 
-    isotonic_is_equal = True
-
     # --------------------------------------------------------- #
     # Note: Class Methods
     #
@@ -593,7 +803,6 @@ class Note(FrozenClass):
             # set octave (may be changed when reading scale_num)
             if octave is None:
                 octave = 0
-            self.octave = octave
 
             # set name
             if scale_num is not None:
@@ -605,9 +814,7 @@ class Note(FrozenClass):
                 # add the octaves together rather than expect them to
                 # match.  This is so that scale_num=3, octave=1 is
                 # allowed and means F1.
-                self.octave += this_octave
-            if name is not None:
-                self.name = name
+                octave += this_octave
 
             # set accidental
             if accidental is None:
@@ -617,42 +824,109 @@ class Note(FrozenClass):
                     accidental = 1
                 else:
                     accidental = 0
-            self.accidental  = accidental
-            if steps is not None and steps != self.steps:
-                raise ValueError("Name %s has steps %d not %d" %
-                                 (self._str_name(name, accidental, octave),
-                                  self.steps, steps))
+            if steps is not None:
+                mysteps = self._name_to_steps(name, accidental, octave)
+                if steps != mysteps:
+                    raise ValueError("Name %s has steps %d not %d" %
+                                     (self._str_name(name, accidental, octave),
+                                      mysteps, steps))
         else:
             if steps is None:
                 raise ValueError("Must specify note name or steps")
             if (accidental is not None or octave is not None):
                 raise ValueError("Cannot specify accidental or octave without specifying the note name")
-            (scale_num, myaccidental, myoctave) = self._steps_to_scale_num(steps)
-            self.name = self._scale_num_to_name(scale_num)[0]
-            self.accidental = myaccidental
-            self.octave = myoctave
+            (scale_num, accidental, octave) = self._steps_to_scale_num(steps)
+            name = self._scale_num_to_name(scale_num)[0]
 
-        if isotonic is not None:
-            self.isotonic_is_equal = isotonic
+        self._set_pitch(name, accidental, octave, isotonic)
 
-        self._freeze()
+    def _set_pitch(self, name, accidental, octave, isotonic=None):
+        """
+        Fill in the slots of a new note, including the ones we compute
+        from the name, accidental and octave, and freeze it.
 
-    # --------------------------------------------------------- #
-    # Note: Properties
-    #
+        pitch_class is the number of half steps above the nearest C
+        below the note, so notes that sound the same in any octave
+        have the same pitch class.
 
-    @property
-    def scale_num(self):
-        return self._scale_name_to_num(self.name, self.octave)
+        >>> Note('E-1').pitch_class
+        4
+        >>> Note('Cb').pitch_class
+        11
+        """
+        setslot = object.__setattr__
+        if isotonic is None:
+            isotonic = type(self)._isotonic_default
+        scale_num = self._scale_name_to_num(name, octave)
+        steps = self._scale_num_to_steps(scale_num, accidental)
+        setslot(self, 'name', name)
+        setslot(self, 'accidental', accidental)
+        setslot(self, 'octave', octave)
+        setslot(self, 'steps', steps)
+        setslot(self, 'scale_num', scale_num)
+        setslot(self, 'pitch_class', steps % self._STEPS_PER_OCTAVE)
+        setslot(self, 'isotonic_is_equal', isotonic)
+        spelling = (type(self), name, accidental, octave)
+        spelling_id = _SPELLING_IDS.get(spelling)
+        if spelling_id is None:
+            # Two threads mustn't hand out the same new id
+            with _SPELLING_IDS_LOCK:
+                spelling_id = _SPELLING_IDS.setdefault(spelling,
+                                                       len(_SPELLING_IDS))
+        setslot(self, '_spelling_id', spelling_id)
+        self._freeze()
 
-    @property
-    def steps(self):
-        return self._name_to_steps(self.name, self.accidental, self.octave)
+    # The canonical instances handed out by Note.of, keyed by class,
+    # name, accidental, octave and the default isotonic_is_equal.
+    # Values are weak so that notes nobody uses any more can go away.
+    _interned = WeakValueDictionary()
+
+    @classmethod
+    def of(cls, name, accidental=0, octave=0):
+        """
+        Return the canonical instance of the class with this name,
+        accidental and octave, creating it the first time.  Equal
+        arguments give back the very same object, so the note
+        arithmetic, which uses this, doesn't allocate a new object for
+        every result.
+
+        >>> Note.of('F', 1) is Note.of('F', 1)
+        True
+        >>> Note.of('F', 1) is Note.of('G', -1)
+        False
+        """
+        key = (cls, name, accidental, octave, cls._isotonic_default)
+        try:
+            return cls._interned[key]
+        except KeyError:
+            pass
+        if name not in cls._NOTE_ORDER:
+            raise ValueError("Unknown note name %s" % name)
+        # We already have the parsed attributes, so skip the parsing
+        # in __init__.
+        note = object.__new__(cls)
+        note._set_pitch(name, accidental, octave)
+        cls._interned[key] = note
+        return note
+
+    def _canonical(self):
+        """
+        Return the canonical instance for this note, see Note.of.
+        Notes that don't use the default isotonic_is_equal are left
+        alone, since Note.of can't make them.
+        """
+        if self.isotonic_is_equal != type(self)._isotonic_default:
+            return self
+        return type(self).of(self.name, self.accidental, self.octave)
 
     # --------------------------------------------------------- #
     # Note: Methods
     #
 
+    def __reduce__(self):
+        return (_unpickle_note, (type(self), self.name, self.accidental,
+                                 self.octave, self.isotonic_is_equal))
+
     def __repr__(self):
         return "%s('%s')" % (self.__class__.__name__, str(self))
 
@@ -660,6 +934,8 @@ class Note(FrozenClass):
         return self._str_name(self.name, self.accidental, self.octave)
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if self.isotonic_is_equal and other.isotonic_is_equal:
             return self.steps == other.steps
         return (self.name == other.name and 
@@ -716,17 +992,28 @@ class Note(FrozenClass):
         """
         if not isinstance(other, Note):
             return self + Interval(steps=other)
+        key = (self._spelling_id, other._spelling_id)
+        try:
+            return _ADD_TABLE[key]
+        except KeyError:
+            pass
+        result = _ADD_CACHE.get(key)
+        if result is None:
+            result = _ADD_CACHE[key] = self._add(other)
+        return result
 
+    def _add(self, other):
         # Note     + Note     = Note
         # Note     + Interval = Note
         # Interval + Note     = Interval
         # Interval + Interval = Interval
         scale_num = self.scale_num + other.scale_num
         accidental = self.steps + other.steps - self._scale_num_to_steps(scale_num)
+        (name, octave) = self._scale_num_to_name(scale_num)
         if isinstance(self, Interval):
-            return Interval(distance=scale_num, accidental=accidental)
+            return Interval.of(name, accidental, octave)
         else:
-            return Note(scale_num=scale_num, accidental=accidental)
+            return Note.of(name, accidental, octave)
 
     def __sub__(self, other):
         """
@@ -758,7 +1045,17 @@ class Note(FrozenClass):
         """
         if not isinstance(other, Note):
             return self - Interval(steps=other)
+        key = (self._spelling_id, other._spelling_id)
+        try:
+            return _SUB_TABLE[key]
+        except KeyError:
+            pass
+        result = _SUB_CACHE.get(key)
+        if result is None:
+            result = _SUB_CACHE[key] = self._sub(other)
+        return result
 
+    def _sub(self, other):
         distance = self.scale_num - other.scale_num
         steps = self.steps - other.steps
         # Note     - Note     = Interval
@@ -767,15 +1064,17 @@ class Note(FrozenClass):
         # Interval - Interval = Interval
         if not isinstance(self, Interval) and isinstance(other, Interval):
             accidental = steps - self._scale_num_to_steps(distance)
-            return Note(scale_num=distance, accidental=accidental)
+            (name, octave) = self._scale_num_to_name(distance)
+            return Note.of(name, accidental, octave)
         else:
             distance = abs(distance)
             accidental = abs(steps) - self._scale_num_to_steps(distance)
-            return Interval(distance=distance, accidental=accidental)
+            (name, octave) = self._scale_num_to_name(distance)
+            return Interval.of(name, accidental, octave)
 
     def match(self, other, nooctave=True):
         if nooctave:
-            return (self.steps - other.steps) % self._STEPS_PER_OCTAVE == 0
+            return self.pitch_class == other.pitch_class
         else:
             return self.steps == other.steps
 
@@ -815,6 +1114,29 @@ F1 = Note('F1')
 
 ##################################################################
 
+def build_arithmetic_tables(octaves=1, accidentals=2):
+    """
+    Fill in the Note arithmetic tables for every pair of notes and
+    intervals within the given number of octaves of middle C, with
+    accidentals from double flat to double sharp (by default).  After
+    that, adding or subtracting two of those is a lookup that never
+    gets evicted.  The tables grow with the square of the range, so
+    octaves=3 means about half a million entries.
+    """
+    operands = []
+    for cls in (Note, Interval):
+        for octave in range(-octaves, octaves+1):
+            for name in Note._NOTE_ORDER:
+                for accidental in range(-accidentals, accidentals+1):
+                    operands.append(cls.of(name, accidental, octave))
+    for a in operands:
+        for b in operands:
+            key = (a._spelling_id, b._spelling_id)
+            _ADD_TABLE[key] = a._add(b)
+            _SUB_TABLE[key] = a._sub(b)
+
+##################################################################
+
 class Interval(Note):
     """
     Interval has the same attributes as Note: name, accidental, octave.  
@@ -851,6 +1173,8 @@ class Interval(Note):
     # Interval: Class Attributes
     #
 
+    __slots__ = ()
+
     _INTERVAL_NAMES=("UNISON",
                      "SECOND",
                      "THIRD",
@@ -1076,12 +1400,37 @@ O   = Interval('P8')
 
 ##################################################################
 
+def _chord_signatures(qualities):
+    """
+    Map the 12 bit pitch class mask of every chord quality, built on
+    every root, to a tuple of the (root pitch class, quality) pairs
+    that have those pitch classes.  Most masks have a single pair, but
+    augmented triads and diminished sevenths are symmetric, so several
+    roots share a mask.
+    """
+    nsteps = Note._STEPS_PER_OCTAVE
+    signatures = {}
+    for quality in sorted(qualities):
+        steps = (0,) + tuple(i.steps for i in qualities[quality])
+        for root in range(nsteps):
+            mask = 0
+            for step in steps:
+                mask |= 1 << ((root + step) % nsteps)
+            signatures.setdefault(mask, []).append((root, quality))
+    return dict((mask, tuple(pairs)) for (mask, pairs) in signatures.iteritems())
+
 class Chord(FrozenClass):
 
     # --------------------------------------------------------- #
     # Chord: Class Attributes
     #
 
+    # The underscored slots hold the cached attributes.
+    __slots__ = ('notes', 'key',
+                 '_root', '_intervals', '_quality', '_is_seventh_chord',
+                 '_inversion', '_real_notes', '_spelling', '_pitch_classes',
+                 '_pitch_mask')
+
     _QUALITIES = {
         # triads
         'major':      (M3, P5),
@@ -1097,6 +1446,13 @@ class Chord(FrozenClass):
         'diminished-seventh': (m3, d5, d7),
         'half-diminished-seventh': (m3, d5, m7)}
 
+    # Hash indexes into _QUALITIES: the sizes of the intervals above
+    # the root of a root position chord, and the pitch class masks of
+    # every quality on every root (see _chord_signatures).
+    _QUALITY_BY_STEPS = dict((tuple(i.steps for i in intervals), quality)
+                             for (quality, intervals) in _QUALITIES.items())
+    _SIGNATURES = _chord_signatures(_QUALITIES)
+
     _KEY_CHORDS = {'I'   : 1,
                    'II'  : 2,
                    'III' : 3,
@@ -1131,21 +1487,7 @@ class Chord(FrozenClass):
 
     @classmethod
     def _intervals_to_quality(cls, intervals):
-        nintervals = len(intervals)
-        if nintervals == 2 or nintervals == 3:
-            for quality in cls._QUALITIES:
-                if (nintervals == 2 and
-                    len(cls._QUALITIES[quality]) == nintervals and
-                    intervals[0] == cls._QUALITIES[quality][0] and
-                    intervals[1] == cls._QUALITIES[quality][1]):
-                    return quality
-                if (nintervals == 3 and
-                    len(cls._QUALITIES[quality]) == nintervals and
-                    intervals[0] == cls._QUALITIES[quality][0] and
-                    intervals[1] == cls._QUALITIES[quality][1] and
-                    intervals[2] == cls._QUALITIES[quality][2]):
-                    return quality
-        return None
+        return cls._QUALITY_BY_STEPS.get(tuple(i.steps for i in intervals))
 
     @staticmethod
     def _notes_to_intervals(notes):
@@ -1155,6 +1497,46 @@ class Chord(FrozenClass):
     def _notes_to_quality(cls, notes):
         return cls._intervals_to_quality(cls._notes_to_intervals(notes))
 
+    @classmethod
+    def recognize(cls, notes):
+        """
+        Work out which chord a collection of notes is, in any order or
+        voicing, with any notes doubled.  Returns a (root, quality,
+        inversion) tuple, or None if the pitch classes aren't one of
+        the known triads or seventh chords.  The root is the lowest of
+        the given notes with the root's pitch class, and the inversion
+        is 0 for root position, 1 when the third is the lowest note,
+        and so on.
+
+        This is a single lookup of the notes' pitch class mask.  When
+        several roots fit (augmented triads and diminished sevenths),
+        the lowest note is taken as the root if it can be.
+
+        >>> Chord.recognize((E, G, C1))
+        (Note('C1'), 'major', 1)
+        >>> Chord.recognize((Note('G-1'), D, G, B, F1))
+        (Note('G-1'), 'dominant-seventh', 0)
+        >>> Chord.recognize((C, D, E)) is None
+        True
+        """
+        nsteps = Note._STEPS_PER_OCTAVE
+        mask = 0
+        for note in notes:
+            mask |= 1 << note.pitch_class
+        candidates = cls._SIGNATURES.get(mask)
+        if candidates is None:
+            return None
+        bass = min(notes)
+        for (root, quality) in candidates:
+            if root == bass.pitch_class:
+                break
+        else:
+            (root, quality) = candidates[0]
+        tones = [root] + [(root + i.steps) % nsteps
+                          for i in cls._QUALITIES[quality]]
+        root_note = min(n for n in notes if n.pitch_class == root)
+        return (root_note, quality, tones.index(bass.pitch_class))
+
     @classmethod
     def _parse_short(cls, short, key):
         orig = short
@@ -1217,12 +1599,57 @@ class Chord(FrozenClass):
         self.key = key
         self._freeze()
 
+    # The canonical instances handed out by Chord.of, keyed by the
+    # spelling of the notes and of the key.
+    _interned = WeakValueDictionary()
+
+    @classmethod
+    def of(cls, notes, key=None):
+        """
+        Return the canonical chord with these notes and key, creating
+        it the first time.  The notes are replaced by their canonical
+        instances, and the cached attributes of a new chord are filled
+        in right away, so every user of the chord shares them.
+
+        >>> Chord.of((G, B, D1)) is Chord.of((D1, B, G))
+        True
+        >>> Chord.of((G, B, D1)) == V
+        True
+        """
+        notes = sorted(n._canonical() for n in notes)
+        if key is not None:
+            key = key._canonical()
+        ikey = (cls,
+                tuple((type(n), n.name, n.accidental, n.octave,
+                       n.isotonic_is_equal) for n in notes),
+                key is not None and (type(key), key.name, key.accidental,
+                                     key.octave, key.isotonic_is_equal))
+        try:
+            return cls._interned[ikey]
+        except KeyError:
+            pass
+        chord = cls(notes=notes, key=key)
+        for attribute in ('root', 'intervals', 'quality', 'inversion',
+                          'real_notes', 'pitch_classes', 'pitch_mask',
+                          'spelling'):
+            getattr(chord, attribute)
+        cls._interned[ikey] = chord
+        return chord
+
     # --------------------------------------------------------- #
     # Chord: Properties
     #
 
+    # A chord whose notes are stacked up from the root is looked up by
+    # its intervals.  Anything else (inversions, doubled notes) is
+    # looked up with Chord.recognize.
+
     @cached_attribute
     def root(self):
+        if self._intervals_to_quality(self.intervals) is None:
+            recognized = self.recognize(self.real_notes)
+            if recognized is not None:
+                return recognized[0]
         if self.key is None:
             return self.notes[0]
         else:
@@ -1234,12 +1661,34 @@ class Chord(FrozenClass):
 
     @cached_attribute
     def quality(self):
-        quality = self._notes_to_quality(self.notes)
+        quality = self._intervals_to_quality(self.intervals)
+        if quality is None:
+            recognized = self.recognize(self.real_notes)
+            if recognized is not None:
+                quality = recognized[1]
         if quality is None:
             return "Unknown"
         else:
             return quality
 
+    @cached_attribute
+    def inversion(self):
+        """
+        0 for a chord in root position, 1 if the third is the lowest
+        note, etc., or None if we don't know what chord this is.
+
+        >>> Chord(notes=(E, G, C1)).inversion
+        1
+        >>> Chord(notes=(E, G, C1))
+        Chord('C1maj/E0')
+        """
+        if self._intervals_to_quality(self.intervals) is not None:
+            return 0
+        recognized = self.recognize(self.real_notes)
+        if recognized is None:
+            return None
+        return recognized[2]
+
     @cached_attribute
     def is_seventh_chord(self):
         return self._quality_is_seventh(self.quality)
@@ -1251,11 +1700,45 @@ class Chord(FrozenClass):
         else:
             return tuple((self.key + n) for n in self.notes)
 
+    @cached_attribute
+    def spelling(self):
+        """
+        Chords compare equal when their notes sound the same, so C#maj
+        == Dbmaj.  The harmonization search has to keep those apart,
+        since they lead to differently spelled harmonizations, so it
+        identifies chords by the name, accidental and octave of their
+        notes instead.
+        """
+        return tuple((n.name, n.accidental, n.octave) for n in self.real_notes)
+
+    @cached_attribute
+    def pitch_classes(self):
+        return tuple(n.pitch_class for n in self.real_notes)
+
+    @cached_attribute
+    def pitch_mask(self):
+        """
+        A 12 bit mask of the pitch classes in the chord: bit n is set
+        if the chord has a note with pitch class n.
+
+        >>> bin(Cmaj.pitch_mask)
+        '0b10010001'
+        """
+        mask = 0
+        for pitch_class in self.pitch_classes:
+            mask |= 1 << pitch_class
+        return mask
+
     # --------------------------------------------------------- #
     # Chord: Methods
     #
 
+    def __reduce__(self):
+        return (_unpickle_chord, (type(self), self.notes, self.key))
+
     def __eq__(self, other):
+        if self is other:
+            return True
         return (self.notes == other.notes and
                 self.key == other.key)
 
@@ -1270,6 +1753,8 @@ class Chord(FrozenClass):
             sfx = ''
             if self._quality_is_seventh(quality):
                 sfx = '7'
+            if self.inversion:
+                sfx += '/%s' % self.real_notes[0]
             return "%s%s%s" % (self.root, self.quality[0:3], sfx)
 
     def __repr__(self):
@@ -1278,7 +1763,7 @@ class Chord(FrozenClass):
     def __add__(self, other):
         if isinstance(other, Note):
             notes = ((n + other) for n in self.real_notes)
-            return Chord(notes=notes)
+            return Chord.of(notes)
         else:
             raise ValueError("Can only add notes and intervals to Chords")
 
@@ -1286,15 +1771,32 @@ class Chord(FrozenClass):
         if exact:
             return note in self.real_notes
         else:
-            return any(n.match(note) for n in self.real_notes)
+            return bool(self.pitch_mask & (1 << note.pitch_class))
 
     def match(self, other, nooctave=True):
+        if nooctave:
+            # Compare the notes pairwise, stopping at the end of the
+            # shorter chord.
+            n = min(len(self.notes), len(other.notes))
+            return self.pitch_classes[:n] == other.pitch_classes[:n]
         return all(s.match(o, nooctave=nooctave)
                    for (s, o) in
                    zip(self.real_notes, other.real_notes))
 
 ##################################################################
 
+def _unpickle_note(cls, name, accidental, octave, isotonic):
+    if isotonic == cls._isotonic_default:
+        return cls.of(name, accidental, octave)
+    note = object.__new__(cls)
+    note._set_pitch(name, accidental, octave, isotonic)
+    return note
+
+def _unpickle_chord(cls, notes, key):
+    return cls.of(notes, key)
+
+##################################################################
+
 ### Chord Constants
 
 Cmaj = Chord(short='Cmaj')
@@ -1334,46 +1836,49 @@ V   = Chord(notes=(G, B,  D1))
 vi  = Chord(notes=(A, C1, E1))
 vii = Chord(notes=(B, D1, F1))  # diminished
 
-PROGRESSIONS = ((I,   IV),  # Circle of fifths
-                (IV,  vii),
-                (vii, iii),
-                (iii, vi),
-                (vi,  ii),
-                (ii,  V),
-                (V,   I),
-
-                (I,   V),   # Pachelbel
-                (V,   vi),
-                (vi,  iii),
-                (iii, IV),
-                (IV,  I),
-                (IV,  V),
-                
-                (I,   vi),  # ii - IV - vi
-                (vi,  IV),
-                (IV,  vi),
-                (IV,  ii),
-                (ii,  IV),
-                (ii,  vi),
-                (vi,  ii),
-                
-                (IV,  I),   # other
-                (I,   iii),
-                (vi,  V),
-                (V,   vi),
-                (V,   ii))
-
-CADENCES = ((V,  I), # Authentic
-            (IV, I), # Plagal
-            (I,  V), # Half
-            (ii, V), # Half
-            (IV, V), # Half
-            (V, vi), # Deceptive
-            (V, IV), # Deceptive
-            (V, ii)) # Deceptive
-
-FINAL_CADENCES = ((V,  I), # Authentic
-                  (IV, I)) # Plagal
+# Each progression is (from chord, to chord, weight).  The weight is
+# the chance of moving to the second chord, given the first one, so
+# the weights of the progressions out of a chord add up to 1 within a
+# table.  They are rough guesses for now; eventually they should be
+# fit to the Bach chorales.  The searches that ignore weights only
+# look at the first two elements, so plain pairs work there too.
+PROGRESSIONS = ((I,   IV,  0.30),  # Circle of fifths
+                (IV,  vii, 0.10),
+                (vii, iii, 1.00),
+                (iii, vi,  0.60),
+                (vi,  ii,  0.40),
+                (ii,  V,   0.70),
+                (V,   I,   0.70),
+
+                (I,   V,   0.35),  # Pachelbel
+                (V,   vi,  0.20),
+                (vi,  iii, 0.10),
+                (iii, IV,  0.40),
+                (IV,  I,   0.25),
+                (IV,  V,   0.35),
+
+                (I,   vi,  0.20),  # ii - IV - vi
+                (vi,  IV,  0.30),
+                (IV,  vi,  0.10),
+                (IV,  ii,  0.20),
+                (ii,  IV,  0.15),
+                (ii,  vi,  0.15),
+
+                (I,   iii, 0.15),  # other
+                (vi,  V,   0.20),
+                (V,   ii,  0.10))
+
+CADENCES = ((V,  I,  0.60), # Authentic
+            (IV, I,  0.50), # Plagal
+            (I,  V,  1.00), # Half
+            (ii, V,  1.00), # Half
+            (IV, V,  0.50), # Half
+            (V,  vi, 0.20), # Deceptive
+            (V,  IV, 0.10), # Deceptive
+            (V,  ii, 0.10)) # Deceptive
+
+FINAL_CADENCES = ((V,  I, 1.00), # Authentic
+                  (IV, I, 1.00)) # Plagal
 
 ##################################################################
 
@@ -1383,12 +1888,279 @@ def apply_progression(progression, chord):
         if chord.real_notes[0] < progression[1].real_notes[0]:
             intv = C - intv
         else:
-            intv = Note(intv)
+            intv = Note.of(intv.name, intv.accidental, intv.octave)
         return (progression[0] + intv, intv)
     else:
         return (None, None)
 
+def progression_weight(progression):
+    """
+    Return the weight of a progression.  Progressions given as plain
+    (from, to) pairs have a weight of 1.
+
+    >>> progression_weight((V, I, 0.6))
+    0.6
+    >>> progression_weight((V, I))
+    1.0
+    """
+    if len(progression) > 2:
+        return progression[2]
+    return 1.0
+
+def _chord_state(chord):
+    """
+    The part of a chord that the progressions care about: the pitch
+    class of its lowest note (the root, unless the chord is inverted),
+    plus the sizes of the intervals above it.  All of the chords with
+    the same state are the same chord in a different octave or
+    spelling.
+    """
+    return (chord.real_notes[0].pitch_class,
+            tuple(i.steps for i in chord.intervals))
+
+class ProgressionIndex(object):
+    """
+    A progression table, indexed so that finding the predecessors of a
+    chord is a dictionary lookup rather than a loop over the table.
+
+    Whether a progression applies, whether its first chord contains
+    the melody note, and whether it duplicates an earlier progression
+    only depend on the shape of the chord (the sizes of its intervals)
+    and on the melody note's pitch class relative to the chord's root.
+    So when the index is built, we work those out once for every shape
+    in the table and every relative pitch class.  Looking up a
+    particular chord then only has to transpose the surviving
+    progressions, and that answer is memoized per chord spelling and
+    melody pitch class, since the search keeps running into the same
+    chords.
+    """
+
+    # Forget the memoized answers when there are more than this many
+    _MEMO_LIMIT = 100000
+
+    def __init__(self, progressions):
+        self.progressions = tuple(progressions)
+        nsteps = Note._STEPS_PER_OCTAVE
+        # self._by_shape maps (shape, relative pitch class) to a tuple
+        # of (progression, weight) pairs, in the order that
+        # get_weighted_predecessors returns the chords.
+        by_shape = {}
+        # How many progressions end in each shape, and how many of
+        # those have each relative pitch class in their first chord
+        # (see counts)
+        self._shape_sizes = {}
+        self._note_counts = {}
+        for progression in self.progressions:
+            (to_root, shape) = _chord_state(progression[1])
+            relative = tuple((pitch_class - to_root) % nsteps
+                             for pitch_class in progression[0].pitch_classes)
+            self._shape_sizes[shape] = self._shape_sizes.get(shape, 0) + 1
+            for pitch_class in set(relative):
+                self._note_counts[(shape, pitch_class)] = \
+                    self._note_counts.get((shape, pitch_class), 0) + 1
+                entries = by_shape.setdefault((shape, pitch_class), [])
+                # Chord.match compares the notes pairwise
+                for (n, (first, weight, first_relative)) in enumerate(entries):
+                    if all(a == b for (a, b) in zip(first_relative, relative)):
+                        entries[n] = (first,
+                                      weight + progression_weight(progression),
+                                      first_relative)
+                        break
+                else:
+                    entries.append((progression,
+                                    progression_weight(progression),
+                                    relative))
+        # A digest of the table's contents, which unlike the index
+        # itself is the same from one run to the next
+        self.digest = sha1(repr(_table_key(self.progressions))).hexdigest()
+        self._by_shape = dict(
+            (key, tuple((progression, weight)
+                        for (progression, weight, relative) in entries))
+            for (key, entries) in by_shape.iteritems())
+        # Lookups read the memo without the lock, which is safe for a
+        # dict; only changes to it take the lock.
+        self._memo = {}
+        self._memo_lock = Lock()
+
+    def predecessors(self, prev_chord, melody_note):
+        """
+        Return a tuple of (chord, weight) pairs, the same as
+        get_weighted_predecessors.
+        """
+        nsteps = Note._STEPS_PER_OCTAVE
+        pitch_class = melody_note.pitch_class
+        key = (prev_chord.spelling, pitch_class)
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        (root, shape) = _chord_state(prev_chord)
+        predecessors = []
+        logging = getLogger().isEnabledFor(DEBUG)
+        for (progression, weight) in self._by_shape.get(
+                (shape, (pitch_class - root) % nsteps), ()):
+            (chord, key_note) = apply_progression(progression, prev_chord)
+            predecessors.append((chord, weight))
+            if logging:
+                debug("{0}->{1} is {2} in {3} Major".format(
+                        chord, prev_chord, progression, key_note))
+        predecessors = tuple(predecessors)
+        with self._memo_lock:
+            if len(self._memo) >= self._MEMO_LIMIT:
+                self._memo.clear()
+            self._memo[key] = predecessors
+        return predecessors
+
+    def counts(self, prev_chord, melody_note):
+        """
+        Return what looping over the table to find the predecessors of
+        prev_chord would have done, as a tuple of the number of
+        progressions that end in a chord like prev_chord, how many of
+        those were rejected because their first chord doesn't contain
+        melody_note, and how many more gave a chord that was already
+        found (see Chord.match).
+        """
+        (root, shape) = _chord_state(prev_chord)
+        key = (shape, (melody_note.pitch_class - root) % Note._STEPS_PER_OCTAVE)
+        tried = self._shape_sizes.get(shape, 0)
+        matching = self._note_counts.get(key, 0)
+        return (tried, tried - matching,
+                matching - len(self._by_shape.get(key, ())))
+
+# Indexes by id(table), holding on to the table so its id can't be
+# reused, and by the contents of the table.
+_INDEXES_BY_ID = {}
+_INDEXES = {}
+
+def _table_key(progressions):
+    """
+    The contents of a progression table, as a dictionary key.  Chords
+    compare equal enharmonically, but a Dbmaj->Gbmaj table and a
+    C#maj->F#maj table spell their answers differently, so the key
+    uses the spellings of the chords (the same data as
+    ProgressionIndex.digest).
+    """
+    return tuple((p[0].spelling, p[1].spelling, progression_weight(p))
+                 for p in progressions)
+
+def get_progression_index(progressions):
+    """
+    Return the ProgressionIndex for a progression table, building it
+    the first time the table is seen.  Tables are assumed not to
+    change once they have been used.
+    """
+    try:
+        (table, index) = _INDEXES_BY_ID[id(progressions)]
+        if table is progressions:
+            return index
+    except KeyError:
+        pass
+    key = _table_key(progressions)
+    if key not in _INDEXES:
+        _INDEXES[key] = ProgressionIndex(progressions)
+    if len(_INDEXES_BY_ID) >= 100:
+        _INDEXES_BY_ID.clear()
+    _INDEXES_BY_ID[id(progressions)] = (progressions, _INDEXES[key])
+    return _INDEXES[key]
+
+def get_weighted_predecessors(prev_chord, melody_note, progressions):
+    """
+    Return (chord, weight) pairs for the chords that can come right
+    before prev_chord while harmonizing melody_note, in the order of
+    the progressions that produce them.  Chords that only differ by
+    octave are only returned once.  When several progressions produce
+    the same chord (V->I and I->IV both go down a fourth), the chord's
+    weight is the sum of their weights.
+    """
+    return list(get_progression_index(progressions).predecessors(
+        prev_chord, melody_note))
+
+def get_predecessors(prev_chord, melody_note, progressions):
+    """
+    Return the chords that can come right before prev_chord while
+    harmonizing melody_note, in the order of the progressions that
+    produce them.  Chords that only differ by octave are only returned
+    once.
+    """
+    return [chord for (chord, weight) in
+            get_progression_index(progressions).predecessors(prev_chord,
+                                                             melody_note)]
+
+class _PartialHarmonization(object):
+    """
+    The end of a harmonization, as a linked list: the first chord and
+    the _PartialHarmonization of the rest.  The search builds
+    harmonizations back to front, and every chord it tries in front of
+    a partial harmonization shares that partial harmonization instead
+    of copying it.  It acts like a read-only list, and tolist makes it
+    into one.
+
+    >>> h = _PartialHarmonization.fromlist([Gmaj, Cmaj])
+    >>> h1 = _PartialHarmonization(Dmaj, h)
+    >>> h2 = _PartialHarmonization(Fmaj, h)
+    >>> len(h1), h1[0], h1.rest is h2.rest
+    (3, Chord('D0maj'), True)
+    >>> h2
+    [Chord('F0maj'), Chord('G0maj'), Chord('C0maj')]
+    """
+
+    __slots__ = ('chord', 'rest', 'length')
+
+    def __init__(self, chord, rest=None):
+        self.chord = chord
+        self.rest = rest
+        if rest is None:
+            self.length = 1
+        else:
+            self.length = rest.length + 1
+
+    @classmethod
+    def fromlist(cls, chords):
+        harmonization = None
+        for chord in reversed(chords):
+            harmonization = cls(chord, harmonization)
+        return harmonization
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        harmonization = self
+        while harmonization is not None:
+            yield harmonization.chord
+            harmonization = harmonization.rest
+
+    def __getitem__(self, n):
+        if n == 0:
+            return self.chord
+        return self.tolist()[n]
+
+    def tolist(self):
+        return list(self)
+
+    def __eq__(self, other):
+        try:
+            return self.tolist() == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    # Equal to lists, so unhashable like them
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.tolist())
+
 def get_harmonizations(harmonization, melody, progressions=None):
+    """
+    Return the harmonizations one chord longer than harmonization (the
+    end of a harmonization of melody).
+    """
     harmonizations = []
     step = len(melody) - len(harmonization)
     melody_note = melody[step-1]
@@ -1398,33 +2170,1742 @@ def get_harmonizations(harmonization, melody, progressions=None):
             progressions = CADENCES
         else:
             progressions = PROGRESSIONS
-    seen = []
-    for progression in progressions:
-        (chord, key) = apply_progression(progression, prev_chord)
-        if (chord is not None and
-            chord.has_note(melody_note) and
-            not any(c.match(chord) for c in seen)):
-            new_harm = [chord]
-            new_harm.extend(harmonization)
-            harmonizations.append(new_harm)
-            seen.append(chord)
-            debug("{0}->{1} is {2} in {3} Major".format(chord, prev_chord,
-                                                        progression, key))
+    for chord in get_predecessors(prev_chord, melody_note, progressions):
+        new_harm = [chord]
+        new_harm.extend(harmonization)
+        harmonizations.append(new_harm)
     return harmonizations
 
 def fill_harmonizations(harmonizations, melody):
+    """
+    Take one step of a breadth first search back through melody:
+    return every harmonization one chord longer than one of
+    harmonizations, as lists.
+    """
     new_harm = []
     for h in harmonizations:
         new_harm.extend(get_harmonizations(h, melody))
     return new_harm
 
-def harmonize(melody=(C, D, E, D, C), final_chord=None):
+def _search_args(melody, final_chord, progressions, cadences):
+    """
+    Fill in the defaults shared by the different searches: the final
+    chord is the major chord on the last note of the melody, and the
+    last progression has to be a cadence.
+    """
+    melody = tuple(melody)
     if final_chord is None:
         final_chord = Cmaj + melody[-1]
-    harmonizations = [[final_chord]]
-    for i in range(len(melody)-1):
-        harmonizations = fill_harmonizations(harmonizations, melody)
-    return harmonizations
+    if progressions is None:
+        progressions = PROGRESSIONS
+    if cadences is None:
+        cadences = CADENCES
+    return (melody, final_chord, progressions, cadences)
+
+class StepStats(object):
+    """
+    What the search did to harmonize one note of the melody.
+
+      position   - the index of the note in the melody
+      note       - the note
+      chords     - the number of chords that can come after it, whose
+                   predecessors were looked for
+      tried      - progressions that end in one of those chords
+      rejected   - tried progressions that don't contain the note
+      duplicates - progressions that gave the same chord (up to
+                   octave) as an earlier one
+      merged     - predecessors that were already found from another
+                   chord, so they were not added to the frontier again
+      frontier   - the number of chords that can harmonize the note
+      seconds    - the wall time taken
+    """
+
+    __slots__ = ('position', 'note', 'chords', 'tried', 'rejected',
+                 'duplicates', 'merged', 'frontier', 'seconds')
+
+    def __init__(self, position, note):
+        self.position = position
+        self.note = note
+        self.chords = self.tried = self.rejected = self.duplicates = 0
+        self.merged = self.frontier = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, ' '.join(
+            '%s=%s' % (name, getattr(self, name)) for name in self.__slots__))
+
+class SearchStats(object):
+    """
+    Statistics from a search, collected by passing a SearchStats as
+    the stats argument of harmonize() or HarmonizationLattice.  steps
+    holds a StepStats for each note, in the order they were searched
+    (from the end of the melody back).  If callback is given, it is
+    called with each StepStats as soon as that step is done.  cached
+    is True when harmonize() found the answer in a cache, in which case
+    there are no steps.
+
+    >>> stats = SearchStats()
+    >>> harmonize(stats=stats, use_cache=False)[0]
+    [Chord('C-1maj'), Chord('G-1maj'), Chord('C0maj'), Chord('G0maj'), Chord('C0maj')]
+    >>> [(s.position, s.chords, s.frontier) for s in stats.steps]
+    [(3, 1, 4), (2, 4, 6), (1, 6, 12), (0, 12, 14)]
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.steps = []
+        self.cached = False
+
+    def step(self, position, note):
+        """
+        Start, and return, the StepStats for the note at position.
+        """
+        step = StepStats(position, note)
+        self.steps.append(step)
+        return step
+
+    def finish(self, step):
+        if self.callback is not None:
+            self.callback(step)
+
+    @property
+    def seconds(self):
+        return sum(step.seconds for step in self.steps)
+
+    def __str__(self):
+        names = StepStats.__slots__
+        lines = [' '.join('%10s' % name for name in names)]
+        for step in self.steps:
+            lines.append(' '.join(
+                ('%10.6f' if name == 'seconds' else '%10s')
+                % getattr(step, name) for name in names))
+        return '\n'.join(lines)
+
+class HarmonizationLattice(object):
+    """
+    All of the harmonizations of a melody, stored as a lattice instead
+    of as a list.
+
+    harmonize() used to keep every partial harmonization as its own
+    list, so the same chord at the same position of the melody was
+    expanded once for every suffix that led to it.  The lattice merges
+    those (position, chord) states: each chord that can harmonize
+    melody[i] is stored once, along with the chords that can come
+    right before it.  The number of states grows with the length of
+    the melody, even though the number of harmonizations grows
+    exponentially.
+
+      count      - the number of harmonizations, computed without
+                   listing them
+
+    Iterating over the lattice lazily expands it into the same lists
+    of chords, in the same order, that harmonize() returns.
+
+    >>> lattice = HarmonizationLattice((C, D, E, D, C))
+    >>> lattice.count
+    95
+    >>> len(list(lattice))
+    95
+    """
+
+    def __init__(self, melody=(C, D, E, D, C), final_chord=None,
+                 progressions=None, cadences=None, stats=None):
+        for _ in self._build(melody, final_chord, progressions, cadences,
+                             stats):
+            pass
+
+    @classmethod
+    def building(cls, melody=(C, D, E, D, C), final_chord=None,
+                 progressions=None, cadences=None, stats=None):
+        """
+        Build a lattice a little at a time: generate None before each
+        chord is expanded, and finally the lattice itself.  Stopping
+        early abandons the search.
+
+        >>> list(HarmonizationLattice.building((D, E, D)))[-1].count
+        13
+        """
+        lattice = cls.__new__(cls)
+        for _ in lattice._build(melody, final_chord, progressions, cadences,
+                                stats):
+            yield None
+        yield lattice
+
+    def _build(self, melody, final_chord, progressions, cadences, stats):
+        (melody, final_chord, progressions, cadences) = \
+            _search_args(melody, final_chord, progressions, cadences)
+        self.melody = melody
+        self.final_chord = final_chord
+
+        # self._levels[i] maps the spelling of each chord that can
+        # harmonize melody[i] to a (chord, predecessor spellings) pair.
+        nlevels = len(self.melody)
+        self._levels = [None] * nlevels
+        self._final = final_chord.spelling
+        level = [(self._final, final_chord)]
+        for i in range(nlevels-1, 0, -1):
+            if i == nlevels - 1:
+                table = cadences
+            else:
+                table = progressions
+            nodes = {}
+            prev_level = []
+            seen = set()
+            if stats is not None:
+                start = time()
+                step = stats.step(i-1, self.melody[i-1])
+                index = get_progression_index(table)
+            for (spelling, chord) in level:
+                yield
+                preds = []
+                for pred in get_predecessors(chord, self.melody[i-1], table):
+                    pred_spelling = pred.spelling
+                    preds.append(pred_spelling)
+                    if pred_spelling not in seen:
+                        seen.add(pred_spelling)
+                        prev_level.append((pred_spelling, pred))
+                    elif stats is not None:
+                        step.merged += 1
+                nodes[spelling] = (chord, tuple(preds))
+                if stats is not None:
+                    (tried, rejected, duplicates) = index.counts(
+                        chord, self.melody[i-1])
+                    step.tried += tried
+                    step.rejected += rejected
+                    step.duplicates += duplicates
+            self._levels[i] = nodes
+            level = prev_level
+            if stats is not None:
+                step.chords = len(nodes)
+                step.frontier = len(prev_level)
+                step.seconds = time() - start
+                stats.finish(step)
+        self._levels[0] = dict((spelling, (chord, ()))
+                               for (spelling, chord) in level)
+        self._count_paths()
+
+    def _count_paths(self):
+        # self._counts[i] maps each spelling at level i to the number of
+        # ways to harmonize melody[:i+1] ending with that chord.
+        nlevels = len(self._levels)
+        self._counts = [None] * nlevels
+        self._counts[0] = dict((spelling, 1) for spelling in self._levels[0])
+        for i in range(1, nlevels):
+            below = self._counts[i-1]
+            self._counts[i] = dict(
+                (spelling, sum(below[p] for p in preds))
+                for (spelling, (chord, preds)) in self._levels[i].iteritems())
+
+    def suffix(self, start):
+        """
+        Return the lattice of the harmonizations of melody[start:],
+        sharing this lattice's levels rather than searching again.
+
+        >>> HarmonizationLattice((C, D, E, D, C)).suffix(2).count
+        10
+        >>> HarmonizationLattice((E, D, C)).count
+        10
+        """
+        if start < 0:
+            start += len(self._levels)
+        lattice = self.__class__.__new__(self.__class__)
+        lattice.melody = self.melody[start:]
+        lattice.final_chord = self.final_chord
+        lattice._final = self._final
+        lattice._levels = ([dict((spelling, (chord, ())) for
+                                 (spelling, (chord, preds))
+                                 in self._levels[start].iteritems())] +
+                           self._levels[start+1:])
+        lattice._count_paths()
+        return lattice
+
+    @property
+    def count(self):
+        return self._counts[-1][self._final]
+
+    @property
+    def num_states(self):
+        return sum(len(level) for level in self._levels)
+
+    def __iter__(self):
+        top = len(self._levels) - 1
+        path = [None] * len(self._levels)
+        path[top] = self._levels[top][self._final][0]
+        if top == 0:
+            yield list(path)
+            return
+        if self.count == 0:
+            return
+        # Depth first, trying predecessors in order, gives the same
+        # order as the breadth first search in harmonize().  Branches
+        # that can't reach the start of the melody are skipped.
+        stack = [(top, iter(self._levels[top][self._final][1]))]
+        while stack:
+            (i, preds) = stack[-1]
+            for spelling in preds:
+                if self._counts[i-1][spelling] > 0:
+                    break
+            else:
+                stack.pop()
+                continue
+            (chord, next_preds) = self._levels[i-1][spelling]
+            path[i-1] = chord
+            if i == 1:
+                yield list(path)
+            else:
+                stack.append((i-1, iter(next_preds)))
+
+    def harmonization_at(self, n):
+        """
+        Return the n-th harmonization, in the order that iterating over
+        the lattice would produce it, without producing the ones before
+        it.  At each position, the per-state counts tell us how many
+        harmonizations go through each predecessor, so we can skip
+        straight to the one that contains the n-th.
+        """
+        count = self.count
+        if n < 0:
+            n += count
+        if not 0 <= n < count:
+            raise IndexError("harmonization index out of range")
+        top = len(self._levels) - 1
+        path = [None] * len(self._levels)
+        (path[top], preds) = self._levels[top][self._final]
+        for i in range(top, 0, -1):
+            for spelling in preds:
+                below = self._counts[i-1][spelling]
+                if n < below:
+                    break
+                n -= below
+            (path[i-1], preds) = self._levels[i-1][spelling]
+        return path
+
+    def sample(self, k, seed=None):
+        """
+        Return k different harmonizations, drawn uniformly at random.
+        seed is passed to random.Random, so the same seed gives the same
+        sample.
+        """
+        rng = Random(seed)
+        count = self.count
+        if k > count:
+            raise ValueError("sample larger than population")
+        if count <= maxsize:
+            indices = rng.sample(xrange(count), k)
+        else:
+            # xrange can't hold the count, but k is tiny next to it, so
+            # drawing again on a repeat almost never happens.
+            indices = []
+            seen = set()
+            while len(indices) < k:
+                n = rng.randrange(count)
+                if n not in seen:
+                    seen.add(n)
+                    indices.append(n)
+        return [self.harmonization_at(n) for n in indices]
+
+def iter_harmonizations(melody=(C, D, E, D, C), final_chord=None,
+                        progressions=None, cadences=None):
+    """
+    Generate the harmonizations of a melody one at a time, in the same
+    order that harmonize() returns them.
+
+    This is a depth first search, so only the chords on the current
+    path, and the predecessors still to be tried at each position, are
+    kept in memory.  Memory grows with the length of the melody rather
+    than with the number of harmonizations, and the first results come
+    out before the rest of the search is done.
+
+    >>> from itertools import islice
+    >>> list(islice(iter_harmonizations((C, D, E, D, C)), 1))
+    [[Chord('C-1maj'), Chord('G-1maj'), Chord('C0maj'), Chord('G0maj'), Chord('C0maj')]]
+    """
+    (melody, final_chord, progressions, cadences) = \
+        _search_args(melody, final_chord, progressions, cadences)
+    top = len(melody) - 1
+    path = [None] * len(melody)
+    path[top] = final_chord
+    if top == 0:
+        yield list(path)
+        return
+    # stack[-1] iterates over the candidates for path[top-len(stack)]
+    stack = [iter(get_predecessors(final_chord, melody[top-1], cadences))]
+    while stack:
+        i = top - len(stack)
+        for chord in stack[-1]:
+            break
+        else:
+            stack.pop()
+            continue
+        path[i] = chord
+        if i == 0:
+            yield list(path)
+        else:
+            stack.append(iter(get_predecessors(chord, melody[i-1],
+                                               progressions)))
+
+def _log_weight(weight):
+    if weight <= 0:
+        return float('-inf')
+    return log(weight)
+
+def beam_harmonize(melody=(C, D, E, D, C), k=10, final_chord=None,
+                   progressions=None, cadences=None, beam_width=None):
+    """
+    Return the k best harmonizations of a melody, as a list of
+    (score, harmonization) pairs, best first.  The score of a
+    harmonization is the sum of the log weights of its progressions.
+
+    Rather than listing every harmonization and sorting them, this
+    only keeps the beam_width (by default, k) best partial
+    harmonizations after each step back through the melody.  That
+    makes it much cheaper than harmonize(), but a partial
+    harmonization that was pruned early could have had a better score
+    in the end, so the answer is approximate unless the beam is at
+    least as wide as the number of partial harmonizations.
+
+    >>> [(round(score, 3), h) for (score, h) in beam_harmonize(k=2)]
+    [(-1.532, [Chord('C-1maj'), Chord('G-1maj'), Chord('C0maj'), Chord('G0maj'), Chord('C0maj')]), (-2.071, [Chord('F-1maj'), Chord('G-1maj'), Chord('C0maj'), Chord('G0maj'), Chord('C0maj')])]
+    """
+    (melody, final_chord, progressions, cadences) = \
+        _search_args(melody, final_chord, progressions, cadences)
+    if beam_width is None:
+        beam_width = k
+    beam = [(0.0, _PartialHarmonization(final_chord))]
+    for i in range(len(melody)-1, 0, -1):
+        if i == len(melody) - 1:
+            table = cadences
+        else:
+            table = progressions
+        candidates = []
+        for (score, harmonization) in beam:
+            for (chord, weight) in get_weighted_predecessors(
+                    harmonization.chord, melody[i-1], table):
+                if weight <= 0:
+                    continue
+                candidates.append(
+                    (score + _log_weight(weight),
+                     _PartialHarmonization(chord, harmonization)))
+        beam = nlargest(beam_width, candidates, key=itemgetter(0))
+    return [(score, harmonization.tolist())
+            for (score, harmonization) in nlargest(k, beam, key=itemgetter(0))]
+
+class TransitionModel(object):
+    """
+    A progression table and a cadence table compiled into dense numpy
+    matrices, for viterbi_harmonize.
+
+      states       - a list of (root pitch class, interval steps) pairs,
+                     one for each transposition of each chord shape in
+                     the tables
+      index        - maps each state to its position in states
+      progressions - progressions[r, s] is the log of the total weight
+                     of the progressions going from state r to state s
+      cadences     - the same, for the cadence table
+      note_masks   - note_masks[pc, s] is True if state s contains the
+                     pitch class pc
+    """
+
+    def __init__(self, progressions, cadences):
+        shapes = []
+        for progression in tuple(progressions) + tuple(cadences):
+            for chord in progression[:2]:
+                shape = _chord_state(chord)[1]
+                if shape not in shapes:
+                    shapes.append(shape)
+        nsteps = Note._STEPS_PER_OCTAVE
+        self.states = [(root, shape) for shape in shapes
+                       for root in range(nsteps)]
+        self.index = dict((state, n) for (n, state) in enumerate(self.states))
+        self.progressions = self._compile(progressions)
+        self.cadences = self._compile(cadences)
+        self.note_masks = numpy.zeros((nsteps, len(self.states)), dtype=bool)
+        for (n, (root, shape)) in enumerate(self.states):
+            for steps in (0,) + shape:
+                self.note_masks[(root + steps) % nsteps, n] = True
+
+    def _compile(self, table):
+        nsteps = Note._STEPS_PER_OCTAVE
+        weights = numpy.zeros((len(self.states), len(self.states)))
+        for progression in table:
+            (from_root, from_shape) = _chord_state(progression[0])
+            (to_root, to_shape) = _chord_state(progression[1])
+            for t in range(nsteps):
+                weights[self.index[((from_root + t) % nsteps, from_shape)],
+                        self.index[((to_root + t) % nsteps, to_shape)]] += \
+                        progression_weight(progression)
+        with numpy.errstate(divide='ignore'):
+            return numpy.log(weights)
+
+_TRANSITION_MODELS = {}
+
+def get_transition_model(progressions, cadences):
+    """
+    Return the TransitionModel for a pair of tables, compiling it the
+    first time the tables are seen.
+    """
+    key = (_table_key(progressions), _table_key(cadences))
+    if key not in _TRANSITION_MODELS:
+        _TRANSITION_MODELS[key] = TransitionModel(progressions, cadences)
+    return _TRANSITION_MODELS[key]
+
+def viterbi_harmonize(melody=(C, D, E, D, C), final_chord=None,
+                      progressions=None, cadences=None):
+    """
+    Return the single best harmonization of a melody, as a (score,
+    harmonization) pair, or None if there is no harmonization.  The
+    score is the same one that beam_harmonize uses.
+
+    This runs the Viterbi algorithm over (root pitch class, chord
+    shape) states, with the transitions taken from a TransitionModel,
+    so it takes time proportional to the length of the melody times
+    the square of the number of states, no matter how many
+    harmonizations there are.  It needs numpy.
+
+    >>> (score, h) = viterbi_harmonize()
+    >>> round(score, 3)
+    -1.532
+    >>> h
+    [Chord('C-1maj'), Chord('G-1maj'), Chord('C0maj'), Chord('G0maj'), Chord('C0maj')]
+    """
+    if numpy is None:
+        raise ImportError("viterbi_harmonize needs numpy")
+    (melody, final_chord, progressions, cadences) = \
+        _search_args(melody, final_chord, progressions, cadences)
+    if len(melody) == 1:
+        return (0.0, [final_chord])
+    model = get_transition_model(progressions, cadences)
+    final_state = model.index.get(_chord_state(final_chord))
+    if final_state is None:
+        return None
+
+    # score[s] is the best score of any harmonization of melody[:i+1]
+    # that ends in state s, and backpointers[i][s] is the state before
+    # s in that harmonization.
+    score = numpy.where(model.note_masks[melody[0].pitch_class],
+                        0.0, -numpy.inf)
+    backpointers = [None] * len(melody)
+    for i in range(1, len(melody)):
+        if i == len(melody) - 1:
+            transitions = model.cadences
+            allowed = numpy.zeros(len(model.states), dtype=bool)
+            allowed[final_state] = True
+        else:
+            transitions = model.progressions
+            allowed = model.note_masks[melody[i].pitch_class]
+        candidates = score[:, numpy.newaxis] + transitions
+        backpointers[i] = candidates.argmax(axis=0)
+        score = numpy.where(allowed, candidates.max(axis=0), -numpy.inf)
+    if numpy.isneginf(score[final_state]):
+        return None
+
+    states = [final_state]
+    for i in range(len(melody)-1, 0, -1):
+        states.append(backpointers[i][states[-1]])
+    states.reverse()
+
+    # Turn the states back into chords by following the progressions
+    # from the final chord, so the chords are spelled the same way
+    # that harmonize() spells them.
+    harmonization = [final_chord]
+    for i in range(len(melody)-1, 0, -1):
+        if i == len(melody) - 1:
+            table = cadences
+        else:
+            table = progressions
+        for chord in get_predecessors(harmonization[0], melody[i-1], table):
+            if model.index[_chord_state(chord)] == states[i-1]:
+                harmonization.insert(0, chord)
+                break
+    return (float(score[final_state]), harmonization)
+
+if numpy is None and viterbi_harmonize.__doc__:
+    # Without numpy, the examples above could only raise ImportError
+    viterbi_harmonize.__doc__ = viterbi_harmonize.__doc__[
+        :viterbi_harmonize.__doc__.index('    >>>')]
+
+def count_harmonizations(melody=(C, D, E, D, C), final_chord=None,
+                         progressions=None, cadences=None):
+    """
+    Return the number of harmonizations of a melody, without listing
+    them.
+
+    The predecessors of a chord only depend on its root's pitch class
+    and its intervals, not on its octave or spelling, so this counts
+    harmonizations per (root pitch class, chord shape) state, one
+    position of the melody at a time.  The work grows with the length
+    of the melody, even when the count is astronomical.
+
+    >>> count_harmonizations()
+    95
+    >>> count_harmonizations((C, D, E, D, C) * 8)
+    94846281370398199
+    """
+    (melody, final_chord, progressions, cadences) = \
+        _search_args(melody, final_chord, progressions, cadences)
+    # counts maps each state to a chord in that state and the number of
+    # ways to harmonize the rest of the melody from that chord.
+    counts = {_chord_state(final_chord): (final_chord, 1)}
+    transitions = {}
+    for i in range(len(melody)-1, 0, -1):
+        if i == len(melody) - 1:
+            table = cadences
+        else:
+            table = progressions
+        pitch_class = melody[i-1].pitch_class
+        new_counts = {}
+        for (state, (chord, n)) in counts.iteritems():
+            key = (state, pitch_class, table is cadences)
+            if key not in transitions:
+                transitions[key] = [(_chord_state(pred), pred) for pred in
+                                    get_predecessors(chord, melody[i-1], table)]
+            for (pred_state, pred) in transitions[key]:
+                if pred_state in new_counts:
+                    new_counts[pred_state] = (new_counts[pred_state][0],
+                                              new_counts[pred_state][1] + n)
+                else:
+                    new_counts[pred_state] = (pred, n)
+        counts = new_counts
+    return sum(n for (chord, n) in counts.itervalues())
+
+def harmonization_at(melody, n, final_chord=None,
+                     progressions=None, cadences=None):
+    """
+    Return harmonize(melody)[n], without computing the others.
+
+    >>> harmonization_at((C, D, E, D, C), 0) == harmonize()[0]
+    True
+    >>> harmonization_at((C, D, E, D, C), -1) == harmonize()[-1]
+    True
+    """
+    lattice = HarmonizationLattice(melody, final_chord=final_chord,
+                                   progressions=progressions,
+                                   cadences=cadences)
+    return lattice.harmonization_at(n)
+
+def sample_harmonizations(melody, k, seed=None, final_chord=None,
+                          progressions=None, cadences=None):
+    """
+    Return k different harmonizations of a melody, drawn uniformly at
+    random from all of them.
+
+    >>> h = sample_harmonizations((C, D, E, D, C), 3, seed=1)
+    >>> h == sample_harmonizations((C, D, E, D, C), 3, seed=1)
+    True
+    >>> all(x in harmonize() for x in h)
+    True
+    """
+    lattice = HarmonizationLattice(melody, final_chord=final_chord,
+                                   progressions=progressions,
+                                   cadences=cadences)
+    return lattice.sample(k, seed=seed)
+
+def _transposition_to_c(note):
+    """
+    Return the Note that takes note to middle C when added to it.
+    Notes add like pairs of (scale_num, steps), so this is just the
+    negation of both.
+
+    >>> Note('F#-1') + _transposition_to_c(Note('F#-1'))
+    Note('C0')
+    """
+    scale_num = -note.scale_num
+    accidental = -note.steps - Note._scale_num_to_steps(scale_num)
+    (name, octave) = Note._scale_num_to_name(scale_num)
+    return Note.of(name, accidental, octave)
+
+class HarmonizationSet(object):
+    """
+    A compact sequence of harmonizations.  A long melody can have
+    millions of harmonizations, but only a few hundred different
+    chords, so each distinct chord is kept once in a table and each
+    harmonization is a row of indexes into it, all stored in a single
+    array.  Indexing, slicing and iterating decode the rows into lists
+    of chords as they are needed.
+
+    >>> h = HarmonizationSet.from_harmonizations(
+    ...     [[Cmaj, Gmaj, Cmaj], [Fmaj, Gmaj, Cmaj]], 3)
+    >>> len(h), len(h.chords), list(h.ids)
+    (2, 3, [0, 1, 0, 2, 1, 0])
+    >>> h[-1]
+    [Chord('F0maj'), Chord('G0maj'), Chord('C0maj')]
+    >>> h[:1] == [[Cmaj, Gmaj, Cmaj]]
+    True
+    """
+
+    def __init__(self, chords, ids, length, complete=True):
+        # chords is the table of distinct chords, ids the concatenated
+        # rows, and length the number of chords in each row.  complete
+        # is False when harmonize() stopped before it found them all.
+        self.chords = chords
+        self.ids = ids
+        self.length = length
+        self.complete = complete
+
+    @classmethod
+    def from_harmonizations(cls, harmonizations, length):
+        """
+        Build a HarmonizationSet from any iterable of harmonizations
+        that are length chords long.  Chords are told apart by their
+        spelling.
+        """
+        chords = []
+        numbers = {}
+        ids = array('H')
+        for harmonization in harmonizations:
+            for chord in harmonization:
+                try:
+                    number = numbers[chord.spelling]
+                except KeyError:
+                    number = numbers[chord.spelling] = len(chords)
+                    chords.append(chord)
+                    if number > 0xffff and ids.typecode == 'H':
+                        ids = array('L', ids)
+                ids.append(number)
+        return cls(tuple(chords), ids, length)
+
+    def _with_final_chord(self, chord):
+        """
+        Return a copy with chord as the last chord of every
+        harmonization, such as the caller's final chord, with its key,
+        in place of the copy that was searched with.  Only the last
+        chords change, even if the same spelling comes up earlier.
+
+        >>> h = HarmonizationSet.from_harmonizations(
+        ...     [[Cmaj, Gmaj, Cmaj], [Fmaj, Gmaj, Cmaj]], 3)
+        >>> h = h._with_final_chord(Chord(notes=(C, E, G), key=F))
+        >>> [c.key for c in h[0]], len(h.chords)
+        ([None, None, Note('F0')], 4)
+        """
+        chords = list(self.chords)
+        ids = self.ids
+        if len(self) > 0:
+            final = ids[self.length - 1]
+            if ids.count(final) == len(self):
+                chords[final] = chord
+            else:
+                final = len(chords)
+                chords.append(chord)
+                if final > 0xffff and ids.typecode == 'H':
+                    ids = array('L', ids)
+                else:
+                    ids = array(ids.typecode, ids)
+                ids[self.length - 1::self.length] = \
+                    array(ids.typecode, [final]) * len(self)
+        return self.__class__(tuple(chords), ids, self.length)
+
+    def __len__(self):
+        if self.length == 0:
+            return 0
+        return len(self.ids) // self.length
+
+    def _row(self, n):
+        chords = self.chords
+        return [chords[i]
+                for i in self.ids[n * self.length:(n + 1) * self.length]]
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            (start, stop, stride) = n.indices(len(self))
+            if stride == 1:
+                ids = self.ids[start * self.length:stop * self.length]
+            else:
+                ids = array(self.ids.typecode)
+                for row in xrange(start, stop, stride):
+                    ids.extend(self.ids[row * self.length:
+                                        (row + 1) * self.length])
+            return self.__class__(self.chords, ids, self.length)
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError("harmonization index out of range")
+        return self._row(n)
+
+    def __iter__(self):
+        for n in xrange(len(self)):
+            yield self._row(n)
+
+    def __eq__(self, other):
+        try:
+            return (len(self) == len(other) and
+                    all(a == b for (a, b) in zip(self, other)))
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return "<%s of %d harmonizations>" % (self.__class__.__name__,
+                                              len(self))
+
+class HarmonizationList(list):
+    """
+    The list of harmonizations that harmonize() returns.  complete is
+    False when the search was stopped by one of harmonize's limits,
+    and the list only has the harmonizations found before that.
+    """
+
+    complete = True
+
+def _harmonization_size(harmonizations):
+    return len(harmonizations.ids)
+
+# Results of harmonize(), keyed by the melody's pitch classes, the
+# final chord and the tables.  With transpose=True, the problem is
+# transposed so the final chord's lowest note is middle C first; the
+# two kinds of key agree when it already is.  The size of an entry is
+# the number of chords in it.
+HARMONIZE_CACHE = LRUCache(1000000, getsize=_harmonization_size)
+
+class HarmonizationStore(object):
+    """
+    A persistent cache of harmonize() results, kept in an SQLite file
+    so that they survive a restart.  Keys can be anything with a
+    stable repr; harmonize uses the same keys as HARMONIZE_CACHE, with
+    the progression indexes replaced by their digests.  Each entry is
+    a HarmonizationSet, stored as its chord table in JSON and its
+    array of indexes.
+
+    Entries older than max_age seconds are deleted.  When the entries
+    hold more than max_size chords in all, the least recently used
+    ones are deleted.
+
+    >>> store = HarmonizationStore(':memory:', max_size=7)
+    >>> store.put('a', ((Cmaj, Gmaj, Cmaj), (Fmaj, Gmaj, Cmaj)))
+    >>> list(store.get('a'))
+    [[Chord('C0maj'), Chord('G0maj'), Chord('C0maj')], [Chord('F0maj'), Chord('G0maj'), Chord('C0maj')]]
+    >>> store.put('b', ((Gmaj, Cmaj),))
+    >>> store.get('a') is None, len(store)
+    (True, 1)
+    >>> store.put('c', ((Cmaj, Gmaj, Fmaj, Cmaj),) * 2)
+    >>> store.get('c') is None, len(store)
+    (True, 1)
+    """
+
+    def __init__(self, path, max_size=1000000, max_age=None):
+        if sqlite3 is None:
+            raise ImportError("HarmonizationStore needs sqlite3")
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        # harmonize_async and serve use the store from other threads
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = Lock()
+        self._db.execute("""CREATE TABLE IF NOT EXISTS harmonizations (
+                                key      TEXT PRIMARY KEY,
+                                chords   TEXT,
+                                typecode TEXT,
+                                indexes  BLOB,
+                                length   INTEGER,
+                                size     INTEGER,
+                                created  REAL,
+                                used     REAL)""")
+        self._db.commit()
+
+    @staticmethod
+    def _digest(key):
+        return sha1(repr(key)).hexdigest()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM harmonizations").fetchone()[0]
+
+    def get(self, key):
+        """
+        Return the HarmonizationSet stored under key, or None.
+        """
+        digest = self._digest(key)
+        with self._lock:
+            row = self._db.execute("""SELECT chords, typecode, indexes,
+                                             length, created
+                                      FROM harmonizations WHERE key = ?""",
+                                   (digest,)).fetchone()
+            if row is None:
+                return None
+            (chords, typecode, indexes, length, created) = row
+            now = time()
+            if self.max_age is not None and created < now - self.max_age:
+                self._evict()
+                return None
+            self._db.execute(
+                "UPDATE harmonizations SET used = ? WHERE key = ?",
+                (now, digest))
+            self._db.commit()
+        chords = [Chord.of(tuple(Note.of(str(name), accidental, octave)
+                                 for (name, accidental, octave) in spelling))
+                  for spelling in json.loads(chords)]
+        return HarmonizationSet(tuple(chords),
+                                array(str(typecode), str(indexes)), length)
+
+    def put(self, key, harmonizations):
+        """
+        Store harmonizations, a HarmonizationSet or a sequence of
+        sequences of chords, under key, and evict whatever no longer
+        fits.  Harmonizations with more than max_size chords in all
+        aren't stored.
+        """
+        if not isinstance(harmonizations, HarmonizationSet):
+            if harmonizations:
+                length = len(harmonizations[0])
+            else:
+                length = 0
+            harmonizations = HarmonizationSet.from_harmonizations(
+                harmonizations, length)
+        ids = harmonizations.ids
+        if len(ids) > self.max_size:
+            # It would only evict everything else, and then itself
+            return
+        row = (self._digest(key),
+               json.dumps([c.spelling for c in harmonizations.chords]),
+               ids.typecode, buffer(ids.tostring()),
+               harmonizations.length, len(ids))
+        with self._lock:
+            now = time()
+            self._db.execute("""INSERT OR REPLACE INTO harmonizations
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                             row + (now, now))
+            self._evict()
+
+    def _evict(self):
+        # The caller holds the lock
+        db = self._db
+        if self.max_age is not None:
+            db.execute("DELETE FROM harmonizations WHERE created < ?",
+                       (time() - self.max_age,))
+        excess = db.execute("SELECT TOTAL(size) FROM harmonizations"
+                            ).fetchone()[0] - self.max_size
+        if excess > 0:
+            doomed = []
+            for (key, size) in db.execute("""SELECT key, size
+                                             FROM harmonizations
+                                             ORDER BY used, rowid""").fetchall():
+                if excess <= 0:
+                    break
+                doomed.append((key,))
+                excess -= size
+            db.executemany("DELETE FROM harmonizations WHERE key = ?", doomed)
+        db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM harmonizations")
+            self._db.commit()
+
+def harmonize(melody=(C, D, E, D, C), final_chord=None,
+              progressions=None, cadences=None, use_cache=True, store=None,
+              compact=False, stats=None, deadline=None, max_results=None,
+              max_expansions=None, transpose=False):
+    """
+    Return every harmonization of a melody, as a list of lists of
+    chords, one chord per note.
+
+    The search can be limited, so that a hard melody can't take
+    forever or use up all of the memory.  It stops when time()
+    reaches deadline, once it has found max_results harmonizations,
+    or after max_expansions expansions, where expanding a chord while
+    the lattice is built (see HarmonizationLattice.building) and
+    listing a harmonization each count as one.  The harmonizations
+    found by then are returned, and the complete attribute of the
+    result (a HarmonizationList) is False.  The lattice has to be
+    built before any harmonizations come out, so a search stopped
+    while it is being built finds none.  Harmonizations are found in
+    order, so those found are always the first ones of the complete
+    answer.
+
+    >>> h = harmonize(max_results=10)
+    >>> (len(h), h.complete)
+    (10, False)
+    >>> h = harmonize((C, D, E, D, C) * 4, max_expansions=20)
+    >>> (len(h), h.complete)
+    (0, False)
+    >>> h = harmonize((C, D, E, D, C) * 4, max_expansions=1000)
+    >>> (len(h), h.complete)
+    (288, False)
+
+    Unless use_cache is False, the harmonizations are looked up in
+    HARMONIZE_CACHE (an LRUCache), searching only when they aren't
+    there, and kept as a HarmonizationSet.  Only the pitch classes of
+    the melody matter to the search, so that is all the cache key
+    keeps of it.
+
+    Transposing a melody and its final chord just transposes all of
+    its harmonizations.  So if transpose is True, we transpose the
+    problem so that the final chord's lowest note is middle C before
+    looking it up, and transpose the answer back, which only means
+    transposing its table of chords.  Then the same tune in another
+    key doesn't need another search.  The transposed harmonizations
+    are the same chords that the search would find directly (they
+    compare equal), but they are spelled the way they are spelled in
+    C.  In some sharp keys, the direct search respells a few chords
+    with double flats; the transposed answer doesn't.
+
+    >>> harmonize((A, B, Es))[0][0]
+    Chord('Ebb0maj')
+    >>> harmonize((A, B, Es), transpose=True)[0][0]
+    Chord('Cx0maj')
+    >>> final_chord = Chord(notes=(G, B, D1), key=D)
+    >>> h = harmonize((E, D, Cs), final_chord=final_chord)
+    >>> h == harmonize((E, D, Cs), final_chord=final_chord, use_cache=False)
+    True
+    >>> h[0][-1].key
+    Note('D0')
+
+    If store (a HarmonizationStore) is given, it is consulted when the
+    harmonizations aren't in HARMONIZE_CACHE, and searches are saved
+    in it, so they survive a restart.  Neither cache is used when
+    use_cache is False.
+
+    If compact is True, the harmonizations are returned as a
+    HarmonizationSet, which takes a fraction of the memory of the
+    list of lists.
+
+    If stats (a SearchStats) is given, it collects statistics from the
+    search, if there was one.  If transpose is True, that search was
+    of the melody transposed to end on C.
+    """
+    (melody, final_chord, progressions, cadences) = \
+        _search_args(melody, final_chord, progressions, cadences)
+    limits = (deadline, max_results, max_expansions)
+    if not use_cache:
+        if not compact and limits == (None, None, None):
+            # Listing the lattice directly skips the round trip
+            # through a HarmonizationSet
+            return HarmonizationList(HarmonizationLattice(
+                melody, final_chord, progressions, cadences, stats))
+        (results, complete) = _bounded_search(
+            melody, final_chord, progressions, cadences, stats, *limits)
+        return _harmonize_results(results, complete, compact)
+
+    if transpose:
+        shift = final_chord.real_notes[0]
+    else:
+        shift = C
+    down = _transposition_to_c(shift)
+    canonical_final = final_chord + down
+    key = (tuple((n + down).pitch_class for n in melody),
+           canonical_final.spelling,
+           get_progression_index(progressions),
+           get_progression_index(cadences))
+    harmonizations = HARMONIZE_CACHE.get(key)
+    complete = True
+    if harmonizations is None:
+        if store is not None:
+            store_key = key[:2] + (key[2].digest, key[3].digest)
+            harmonizations = store.get(store_key)
+        if harmonizations is not None and stats is not None:
+            stats.cached = True
+        if harmonizations is None:
+            (harmonizations, complete) = _bounded_search(
+                tuple(n + down for n in melody), canonical_final,
+                progressions, cadences, stats, *limits)
+            if complete and store is not None:
+                store.put(store_key, harmonizations)
+        if complete:
+            HARMONIZE_CACHE[key] = harmonizations
+    elif stats is not None:
+        stats.cached = True
+    if max_results is not None and len(harmonizations) > max_results:
+        harmonizations = harmonizations[:max_results]
+        complete = False
+
+    if shift is not C:
+        harmonizations = HarmonizationSet(
+            tuple(chord + shift for chord in harmonizations.chords),
+            harmonizations.ids, len(melody))
+    # Give back the caller's final chord, with its key, rather than the
+    # copy that was searched with
+    results = harmonizations._with_final_chord(final_chord)
+    return _harmonize_results(results, complete, compact)
+
+def _bounded_search(melody, final_chord, progressions, cadences, stats,
+                    deadline, max_results, max_expansions):
+    """
+    Search for harmonize(), within its limits, and return a
+    HarmonizationSet of the harmonizations found and whether that is
+    all of them.
+    """
+    if deadline is None and max_results is None and max_expansions is None:
+        lattice = HarmonizationLattice(melody, final_chord, progressions,
+                                       cadences, stats)
+        return (HarmonizationSet.from_harmonizations(lattice, len(melody)),
+                True)
+
+    expansions = 0
+    for lattice in HarmonizationLattice.building(melody, final_chord,
+                                                 progressions, cadences,
+                                                 stats):
+        if lattice is not None:
+            break
+        expansions += 1
+        if ((max_expansions is not None and expansions > max_expansions) or
+            (deadline is not None and time() >= deadline)):
+            return (HarmonizationSet((), array('H'), len(melody)), False)
+
+    # Listing a harmonization counts as an expansion too, so that
+    # max_expansions bounds the listing of a huge lattice
+    if max_expansions is not None:
+        budget = max_expansions - expansions
+        if max_results is None or budget < max_results:
+            max_results = budget
+
+    stopped = []
+
+    def bounded():
+        for (n, harmonization) in enumerate(lattice):
+            if ((max_results is not None and n >= max_results) or
+                (deadline is not None and time() >= deadline)):
+                stopped.append(True)
+                return
+            yield harmonization
+
+    harmonizations = HarmonizationSet.from_harmonizations(bounded(),
+                                                          len(melody))
+    return (harmonizations, not stopped)
+
+def _harmonize_results(harmonizations, complete, compact):
+    harmonizations.complete = complete
+    if compact:
+        return harmonizations
+    results = HarmonizationList(harmonizations)
+    results.complete = complete
+    return results
+
+# Index the default tables up front
+for _table in (PROGRESSIONS, CADENCES, FINAL_CADENCES):
+    get_progression_index(_table)
+del _table
+
+class HarmonizationTask(object):
+    """
+    A harmonize() that runs a little at a time, so that a big search
+    can share a thread with an event loop instead of blocking it.
+    Each call to step does a bounded amount of work (expanding up to
+    budget chords, or listing up to budget harmonizations) and returns
+    the harmonizations it found, so the loop can get on with other
+    things in between, and cancel() abandons the search.
+
+      done       - True once the search is finished or cancelled
+      cancelled  - True if it was cancelled
+      results    - every harmonization found so far, in the order
+                   harmonize(use_cache=False) returns them
+
+    >>> task = HarmonizationTask((C, D, E, D, C))
+    >>> while not task.done:
+    ...     new = task.step(10)
+    >>> len(task.results)
+    95
+    >>> task = HarmonizationTask((C, D, E, D, C))
+    >>> (task.step(5), task.cancel(), task.step(5), task.done)
+    ([], None, [], True)
+    """
+
+    def __init__(self, melody=(C, D, E, D, C), final_chord=None,
+                 progressions=None, cadences=None):
+        self._building = HarmonizationLattice.building(
+            melody, final_chord, progressions, cadences)
+        self._harmonizations = None
+        self.results = []
+        self.done = False
+        self.cancelled = False
+
+    def step(self, budget=1000):
+        """
+        Do up to budget units of work, and return the list of
+        harmonizations found by it.
+        """
+        if self.done:
+            return []
+        if self._harmonizations is None:
+            for result in islice(self._building, budget):
+                if result is not None:
+                    self._harmonizations = iter(result)
+                    break
+            return []
+        new = list(islice(self._harmonizations, budget))
+        if len(new) < budget:
+            self.done = True
+        self.results.extend(new)
+        return new
+
+    def cancel(self):
+        """
+        Abandon the search.  The harmonizations found so far stay in
+        results.
+        """
+        self.cancelled = self.done = True
+        self._building = self._harmonizations = None
+
+    def __iter__(self):
+        """
+        Run the task to the end, generating each harmonization as it is
+        found, and None after each step that didn't find any, as a
+        chance to do something else (or cancel).
+        """
+        while not self.done:
+            new = self.step()
+            if new:
+                for harmonization in new:
+                    yield harmonization
+            else:
+                yield None
+
+# A pool of threads for harmonize_async, made the first time it is needed
+_ASYNC_POOL = None
+
+def harmonize_async(melody=(C, D, E, D, C), pool=None, callback=None,
+                    **kwargs):
+    """
+    Start harmonize(melody, **kwargs) in the background, and return a
+    multiprocessing AsyncResult for it; callback, if given, is called
+    with the harmonizations when they are ready (in a thread of the
+    pool, so an event loop will want it to hand them over in a
+    thread-safe way).  By default, the search runs in a pool of
+    threads, which keeps it from blocking the caller's thread; pass a
+    multiprocessing Pool to run it on another core.
+
+    >>> len(harmonize_async((D, E, D)).get(10))
+    13
+    """
+    global _ASYNC_POOL
+    if pool is None:
+        if _ASYNC_POOL is None:
+            from multiprocessing.pool import ThreadPool
+            _ASYNC_POOL = ThreadPool(2)
+        pool = _ASYNC_POOL
+    kwargs['melody'] = tuple(melody)
+    return pool.apply_async(harmonize, (), kwargs, callback)
+
+# The progression tables for the worker processes of harmonize_many
+# and parallel_harmonize, set by _init_worker so that they are sent to
+# each worker once rather than with every task.  Tasks run in this
+# process are given their tables directly instead.
+_WORKER_TABLES = (None, None)
+
+def _init_worker(progressions, cadences):
+    global _WORKER_TABLES
+    _WORKER_TABLES = (progressions, cadences)
+
+def _harmonize_task(task, tables=None):
+    """
+    Harmonize one melody for harmonize_many.  The search only looks at
+    the pitch classes of the melody, so it is sent as a tuple of
+    steps, but the spelling of the final chord matters, so that is
+    sent as its spelling.  tables is (progressions, cadences), by
+    default the worker's.
+    """
+    (index, steps, final_spelling) = task
+    (progressions, cadences) = tables or _WORKER_TABLES
+    melody = tuple(Note(steps=n) for n in steps)
+    final_chord = Chord.of(tuple(Note.of(*n) for n in final_spelling))
+    return (index, harmonize(melody, final_chord, progressions, cadences,
+                             compact=True))
+
+def harmonize_many(melodies, workers=None, chunksize=None, ordered=True,
+                   final_chords=None, progressions=None, cadences=None,
+                   compact=False):
+    """
+    Harmonize many melodies at once, in a pool of workers processes,
+    and generate an (index, harmonizations) pair for each, where
+    harmonizations is what harmonize() returns for melodies[index].
+    The pairs come in the order of melodies if ordered is True, and
+    as soon as each is ready otherwise.
+
+    workers is the number of processes (by default, one per CPU); with
+    one worker, the melodies are harmonized in this process.  The
+    melodies are handed out chunksize at a time (by default, about
+    four chunks per worker), and come back as HarmonizationSets, which
+    are much cheaper to send than lists of chords.  final_chords, if
+    given, has the final chord for each melody.
+
+    >>> melodies = [(C, D, E, D, C), (D, E, D), (G, F, E, D, C)]
+    >>> [(i, len(h)) for (i, h) in harmonize_many(melodies, workers=2)]
+    [(0, 95), (1, 13), (2, 57)]
+    """
+    from multiprocessing import cpu_count
+    melodies = [tuple(melody) for melody in melodies]
+    if final_chords is None:
+        final_chords = [Cmaj + melody[-1] for melody in melodies]
+    else:
+        final_chords = list(final_chords)
+    if workers is None:
+        workers = cpu_count()
+    if chunksize is None:
+        chunksize = max(1, len(melodies) // (4 * workers))
+
+    def results(harmonized):
+        for (index, harmonizations) in harmonized:
+            # Give back the caller's final chord, rather than the copy
+            # the worker made from its spelling.
+            harmonizations = harmonizations._with_final_chord(
+                final_chords[index])
+            if not compact:
+                harmonizations = list(harmonizations)
+            yield (index, harmonizations)
+
+    tasks = ((index, tuple(n.steps for n in melody),
+              final_chords[index].spelling)
+             for (index, melody) in enumerate(melodies))
+    harmonized = _pool_map(_harmonize_task, tasks, workers, chunksize,
+                           ordered, progressions, cadences)
+    for result in results(harmonized):
+        yield result
+
+def _pool_map(function, tasks, workers, chunksize=1, ordered=True,
+              progressions=None, cadences=None):
+    """
+    Generate function(task) for each of tasks, in a pool of workers
+    processes that have the progression tables (see _init_worker), or
+    in this process, as function(task, (progressions, cadences)), if
+    workers is 1 or less.
+    """
+    from multiprocessing import Pool
+    if workers <= 1:
+        for task in tasks:
+            yield function(task, (progressions, cadences))
+        return
+    pool = Pool(workers, _init_worker, (progressions, cadences))
+    try:
+        if ordered:
+            results = pool.imap(function, tasks, chunksize)
+        else:
+            results = pool.imap_unordered(function, tasks, chunksize)
+        for result in results:
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _subtree_task(task, tables=None):
+    """
+    Harmonize (or count the harmonizations of) the start of a melody
+    for parallel_harmonize, ending on the chord with the given
+    spelling.  That chord is followed by more melody, so the last
+    progression is an ordinary one rather than a cadence.  tables is
+    as for _harmonize_task.
+    """
+    (spelling, steps, count) = task
+    progressions = (tables or _WORKER_TABLES)[0]
+    if progressions is None:
+        progressions = PROGRESSIONS
+    melody = tuple(Note(steps=n) for n in steps)
+    final_chord = Chord.of(tuple(Note.of(*n) for n in spelling))
+    if count:
+        return (spelling, count_harmonizations(melody, final_chord,
+                                               progressions, progressions))
+    lattice = HarmonizationLattice(melody, final_chord, progressions,
+                                   progressions)
+    return (spelling, HarmonizationSet.from_harmonizations(lattice,
+                                                           len(melody)))
+
+# The furthest from the end of the melody that parallel_harmonize
+# looks for a place to split the search
+_MAX_SPLIT_DEPTH = 8
+
+def _split_search(melody, final_chord, progressions, cadences, split, parts):
+    """
+    Return (j, lattice), where lattice holds the harmonizations of
+    melody[j:], and its first level (the chords that can harmonize
+    melody[j]) is where parallel_harmonize splits the search, or None
+    if splitting isn't worth it.
+
+    If split is None, the search goes back at most _MAX_SPLIT_DEPTH
+    steps, and no further than half way, so that the workers are left
+    with most of the work.  j is as close to the end as possible while
+    there are at least parts chords there to hand out, or failing
+    that, where there are the most chords.  If there is never more
+    than one, there is nothing to split.  The search always takes at
+    least one step, so the cadence is part of it.
+    """
+    nlevels = len(melody)
+    if split is not None:
+        j = min(max(nlevels - 1 - split, 0), nlevels - 2)
+        return (j, HarmonizationLattice(melody[j:], final_chord,
+                                        progressions, cadences))
+    depth = max(1, min(_MAX_SPLIT_DEPTH, (nlevels - 1) // 2))
+    lattice = HarmonizationLattice(melody[-depth-1:], final_chord,
+                                   progressions, cadences)
+    # lattice._levels[depth-d] holds the chords d steps from the end
+    widths = [(len(lattice._levels[depth-d]), d) for d in range(1, depth+1)]
+    for (width, d) in widths:
+        if width >= parts:
+            break
+    else:
+        (width, d) = max(widths, key=lambda (width, d): (width, -d))
+    if width < 2:
+        return None
+    return (nlevels - 1 - d, lattice.suffix(depth - d))
+
+def _parallel_args(melody, workers, final_chord, progressions, cadences):
+    from multiprocessing import cpu_count
+    (melody, final_chord, progressions, cadences) = \
+        _search_args(melody, final_chord, progressions, cadences)
+    if workers is None:
+        workers = cpu_count()
+    return (melody, workers, final_chord, progressions, cadences)
+
+def parallel_harmonize(melody=(C, D, E, D, C), workers=None, split=None,
+                       final_chord=None, progressions=None, cadences=None,
+                       compact=False):
+    """
+    Return the same harmonizations as harmonize(use_cache=False), in
+    the same order, but split the search across workers processes (by
+    default, one per CPU).
+
+    The search runs back from the end of the melody for split steps
+    (by default, until there are a few chords per worker; see
+    _split_search), and each chord it can reach there is handed to a
+    worker, which harmonizes the start of the melody up to that chord.
+    The ends found here and the starts found by the workers are then
+    joined up, in order.
+    Since every harmonization still has to be written out here, the
+    speedup is limited when there are very many of them.
+
+    >>> parallel_harmonize(workers=2) == harmonize(use_cache=False)
+    True
+    """
+    (melody, workers, final_chord, progressions, cadences) = \
+        _parallel_args(melody, workers, final_chord, progressions, cadences)
+    if len(melody) < 3 or workers <= 1:
+        harmonizations = HarmonizationLattice(melody, final_chord,
+                                              progressions, cadences)
+        if compact:
+            return HarmonizationSet.from_harmonizations(harmonizations,
+                                                        len(melody))
+        return list(harmonizations)
+
+    split_search = _split_search(melody, final_chord, progressions, cadences,
+                                 split, 4 * workers)
+    if split_search is None:
+        return harmonize(melody, final_chord, progressions, cadences,
+                         use_cache=False, compact=compact)
+    (j, ends) = split_search
+    steps = tuple(n.steps for n in melody[:j+1])
+    tasks = [(spelling, steps, False) for spelling in ends._levels[0]]
+    starts = dict(_pool_map(_subtree_task, tasks, workers, 1, False,
+                            progressions, cadences))
+
+    def join():
+        for end in ends:
+            for start in starts[end[0].spelling]:
+                start[-1:] = end
+                yield start
+
+    harmonizations = HarmonizationSet.from_harmonizations(join(), len(melody))
+    if compact:
+        return harmonizations
+    return list(harmonizations)
+
+def parallel_count_harmonizations(melody=(C, D, E, D, C), workers=None,
+                                  split=None, final_chord=None,
+                                  progressions=None, cadences=None):
+    """
+    Return the same number as count_harmonizations, splitting the
+    search across workers processes the same way as
+    parallel_harmonize: the number of harmonizations is the sum, over
+    the chords where the search is split, of the number of ways to
+    get from that chord to the end, times the number of ways to get
+    from the start to that chord.
+
+    >>> parallel_count_harmonizations((C, D, E, D, C) * 8, workers=2)
+    94846281370398199
+    """
+    (melody, workers, final_chord, progressions, cadences) = \
+        _parallel_args(melody, workers, final_chord, progressions, cadences)
+    if len(melody) < 3 or workers <= 1:
+        return count_harmonizations(melody, final_chord, progressions,
+                                    cadences)
+
+    split_search = _split_search(melody, final_chord, progressions, cadences,
+                                 split, 4 * workers)
+    if split_search is None:
+        return count_harmonizations(melody, final_chord, progressions,
+                                    cadences)
+    (j, ends) = split_search
+    # The number of ways to get from each chord at the split to the end
+    ways = {ends._final: 1}
+    for i in range(len(ends._levels) - 1, 0, -1):
+        below = {}
+        for (spelling, n) in ways.iteritems():
+            for pred in ends._levels[i][spelling][1]:
+                below[pred] = below.get(pred, 0) + n
+        ways = below
+    steps = tuple(n.steps for n in melody[:j+1])
+    tasks = [(spelling, steps, True) for spelling in ways]
+    return sum(ways[spelling] * n for (spelling, n) in
+               _pool_map(_subtree_task, tasks, workers, 1, False,
+                         progressions, cadences))
+
+def harmonization_json(line, count=False, top=None, store=None, names=None):
+    """
+    Harmonize the melody on line (notes separated by spaces, as on the
+    command line), and return a line of JSON with the melody and the
+    number of harmonizations.  Unless count is True, it also has the
+    harmonizations, or if top is given, just the top best ones (see
+    beam_harmonize, which is given a beam at least 100 wide) and their
+    scores.  A melody that can't be read gets an error instead.  Blank
+    lines and lines starting with # give None.
+
+    names maps chord spellings to chord names, so that each name is
+    only worked out once; it can be a dict or an LRUCache.  The
+    harmonizations stay compact (see HarmonizationSet) until they are
+    written out.  store is passed to harmonize().
+
+    >>> harmonization_json('C D E D C', top=1)
+    '{"melody":["C0","D0","E0","D0","C0"],"count":95,"harmonizations":[["C-1maj","G-1maj","C0maj","G0maj","C0maj"]],"scores":[-1.532]}'
+    >>> harmonization_json('C H') # doctest: +ELLIPSIS
+    '{"melody":"C H","error":"..."}'
+    """
+    if names is None:
+        names = {}
+
+    def name(chord):
+        result = names.get(chord.spelling)
+        if result is None:
+            result = names[chord.spelling] = str(chord)
+        return result
+
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    try:
+        melody = tuple(Note(n) for n in line.split())
+    except Exception, e:
+        result = [('melody', line), ('error', str(e))]
+    else:
+        result = [('melody', [str(n) for n in melody])]
+        if count:
+            result.append(('count', count_harmonizations(melody)))
+        elif top is not None:
+            # With a beam only top wide, the search is nearly greedy
+            best = beam_harmonize(melody, k=top,
+                                  beam_width=max(10 * top, 100))
+            result.append(('count', count_harmonizations(melody)))
+            result.append(('harmonizations',
+                           [[name(c) for c in h] for (score, h) in best]))
+            result.append(('scores', [round(score, 3)
+                                      for (score, h) in best]))
+        else:
+            harmonizations = harmonize(melody, store=store, compact=True)
+            table = [name(c) for c in harmonizations.chords]
+            ids = harmonizations.ids
+            length = harmonizations.length
+            result.append(('count', len(harmonizations)))
+            result.append(('harmonizations',
+                           [[table[i] for i in ids[n:n + length]]
+                            for n in xrange(0, len(ids), length)]))
+    return json.dumps(OrderedDict(result), separators=(',', ':'))
+
+def harmonize_lines(lines, out, count=False, top=None, store=None):
+    """
+    Harmonize a stream of melodies, one per line, and write a line of
+    JSON (see harmonization_json) to out for each, as soon as it is
+    done.  Each chord's name is only worked out once per stream.
+    """
+    names = {}
+    for line in lines:
+        result = harmonization_json(line, count, top, store, names)
+        if result is not None:
+            out.write(result)
+            out.write('\n')
+
+# Chord names for _serve_task, which has no stream to keep them for
+_CHORD_NAMES = LRUCache(10000)
+
+# The HarmonizationStore of a serve worker process, opened by
+# _init_serve_worker, since a connection can't be sent to a process.
+_SERVE_STORE = None
+
+# How often, in seconds, serve checks whether the pool a search is
+# waiting on has been replaced
+_SERVE_POLL = 0.1
+
+def _init_serve_worker(path, max_size, max_age):
+    global _SERVE_STORE
+    _SERVE_STORE = HarmonizationStore(path, max_size, max_age)
+
+def _serve_task(task, store=None):
+    (line, count, top) = task
+    if store is None:
+        store = _SERVE_STORE
+    return harmonization_json(line, count, top, store, names=_CHORD_NAMES)
+
+def serve(address, workers=None, count=False, top=None, timeout=600,
+          store=None):
+    """
+    Answer harmonization requests until interrupted, keeping the
+    progression indexes and the caches warm between requests.
+
+    If address contains a /, it is the path of a Unix socket; a client
+    writes one melody per line, and reads a line of JSON (see
+    harmonization_json) back for each.  Otherwise, address is a port
+    (or host:port, by default on localhost) for HTTP: GET
+    /harmonize?melody=C+D+E&top=3 returns one line of JSON, and a POST
+    to /harmonize with one melody per line returns a line for each.
+    count and top apply when a request doesn't give them.
+
+    Each connection has a thread of its own, and the searches are
+    handed to a pool of workers processes (by default, one per CPU),
+    each with caches of its own; with no workers, they run one at a
+    time in the serving threads.  A search that takes longer than
+    timeout seconds gives an error, and the pool is replaced, so that
+    the worker stuck with it doesn't go on searching.  The searches
+    still waiting on the old pool start again on the new one.
+
+    store is a HarmonizationStore to keep the harmonizations in; each
+    worker process opens one of its own on the same file.
+    """
+    from multiprocessing import Pool, TimeoutError, cpu_count
+    from SocketServer import (ThreadingMixIn, UnixStreamServer,
+                              StreamRequestHandler)
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from urlparse import urlparse, parse_qs
+    import os
+    import stat
+
+    if workers is None:
+        workers = cpu_count()
+
+    def new_pool():
+        if store is None:
+            return Pool(workers)
+        return Pool(workers, _init_serve_worker,
+                    (store.path, store.max_size, store.max_age))
+
+    # pools[0] is the current pool, replaced under lock when a search
+    # times out; with no workers, lock serializes the searches instead.
+    lock = Lock()
+    if workers > 0:
+        pools = [new_pool()]
+    else:
+        pools = [None]
+
+    def search(task):
+        pool = pools[0]
+        if pool is None:
+            with lock:
+                return _serve_task(task, store)
+        deadline = time() + timeout
+        result = pool.apply_async(_serve_task, (task,))
+        while True:
+            # wait() with a timeout, because a plain wait() can't be
+            # interrupted, and in slices, to notice a new pool
+            result.wait(max(0, min(deadline - time(), _SERVE_POLL)))
+            if result.ready():
+                return result.get()
+            if time() >= deadline:
+                with lock:
+                    # Requests that timed out together only replace it
+                    # once
+                    if pools[0] is pool:
+                        pools[0] = new_pool()
+                        pool.terminate()
+                raise TimeoutError(
+                    "no answer in %s seconds" % timeout)
+            if pools[0] is not pool:
+                # Another search timed out and took this one's pool
+                # with it, so start again on the new one
+                pool = pools[0]
+                deadline = time() + timeout
+                result = pool.apply_async(_serve_task, (task,))
+
+    def answer(line, count, top):
+        try:
+            return search((line, count, top))
+        except Exception, e:
+            return json.dumps(OrderedDict([('melody', line.strip()),
+                                           ('error', str(e))]),
+                              separators=(',', ':'))
+
+    class LineHandler(StreamRequestHandler):
+        def handle(self):
+            for line in iter(self.rfile.readline, ''):
+                result = answer(line, count, top)
+                if result is not None:
+                    self.wfile.write(result + '\n')
+                    self.wfile.flush()
+
+    class HTTPHandler(BaseHTTPRequestHandler):
+        def options(self, url):
+            params = parse_qs(url.query)
+            request_count = count
+            if 'count' in params:
+                request_count = params['count'][0] not in ('', '0', 'false')
+            request_top = top
+            if 'top' in params:
+                request_top = int(params['top'][0])
+            return (params, request_count, request_top)
+
+        def reply(self, code, body):
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/harmonize':
+                self.send_error(404)
+                return
+            try:
+                (params, request_count, request_top) = self.options(url)
+                melody = params['melody'][0]
+            except (KeyError, ValueError):
+                self.send_error(400)
+                return
+            self.reply(200, (answer(melody, request_count, request_top)
+                             or '') + '\n')
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/harmonize':
+                self.send_error(404)
+                return
+            try:
+                (params, request_count, request_top) = self.options(url)
+                length = int(self.headers.getheader('Content-Length', 0))
+            except ValueError:
+                self.send_error(400)
+                return
+            results = (answer(line, request_count, request_top)
+                       for line in self.rfile.read(length).splitlines())
+            self.reply(200, ''.join(result + '\n' for result in results
+                                    if result is not None))
+
+        def log_message(self, format, *args):
+            debug(format % args)
+
+    if '/' in address:
+        class Server(ThreadingMixIn, UnixStreamServer):
+            daemon_threads = True
+        # A socket left behind by an earlier server would stop us
+        # binding to the path.
+        try:
+            if stat.S_ISSOCK(os.stat(address).st_mode):
+                os.unlink(address)
+        except OSError:
+            pass
+        server = Server(address, LineHandler)
+    else:
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+        (host, _, port) = address.rpartition(':')
+        server = Server((host or 'localhost', int(port)), HTTPHandler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if '/' in address:
+            os.unlink(address)
+        if pools[0] is not None:
+            pools[0].terminate()
+            pools[0].join()
 
 ##################################################################
 
@@ -1497,12 +3978,36 @@ def harmonize(melody=(C, D, E, D, C), final_chord=None):
 
 #
 # To profile, run:
-#    python -m cProfile -o output.txt code/github/Harmonize/harmonize.py D A B A G 'F#' E D
-# Then, in ipython:
+#    python harmonize.py --profile D A B A G 'F#' E D
+# which prints the functions with the most cumulative time (and the
+# peak memory use) to stderr.  --profile-out output.txt saves the
+# profile, which can then be loaded in ipython:
 #    import pstats
 #    p = pstats.Stats('output.txt')
-#    psort_stats('cumulative').print_stats(10)
+#    p.sort_stats('cumulative').print_stats(10)
 #
+def profile_call(function, args=(), kwargs={}, limit=None, out=None):
+    """
+    Call function under cProfile and return its result.  If limit is
+    given, print the limit entries with the most cumulative time to
+    stderr, along with the peak memory use of the process.  If out is
+    given, save the profile there, for pstats.
+    """
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    result = profiler.runcall(function, *args, **kwargs)
+    if out is not None:
+        profiler.dump_stats(out)
+    if limit is not None:
+        stats = pstats.Stats(profiler, stream=stderr)
+        stats.sort_stats('cumulative').print_stats(limit)
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux (bytes on Mac OS X)
+            print >> stderr, "peak memory: %d" % \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
 def main():
     """
     Main body of the script.
@@ -1515,10 +4020,31 @@ def main():
 
     if opts.verbose:
         logat('DEBUG')
+    if opts.cache:
+        store = HarmonizationStore(opts.cache, max_age=opts.cache_max_age)
+    else:
+        store = None
+    if opts.serve:
+        serve(opts.serve, opts.workers, opts.count, opts.top, opts.timeout,
+              store)
+        return
+    if opts.batch:
+        if opts.batch == '-':
+            harmonize_lines(stdin, stdout, opts.count, opts.top, store)
+        else:
+            with open(opts.batch) as lines:
+                harmonize_lines(lines, stdout, opts.count, opts.top, store)
+        stdout.flush()
+        return
     if len(args) > 0:
-        h = harmonize(melody=tuple(Note(a) for a in args))
+        kwargs = dict(melody=tuple(Note(a) for a in args), store=store)
+    else:
+        kwargs = dict(store=store)
+    if opts.profile or opts.profile_out:
+        h = profile_call(harmonize, kwargs=kwargs, out=opts.profile_out,
+                         limit=opts.profile_limit if opts.profile else None)
     else:
-        h = harmonize()
+        h = harmonize(**kwargs)
     for harmony in h:
         print harmony
 
@@ -1533,6 +4059,40 @@ def getopts():
     parser.add_option('--verbose', '-v',
                       action='store_true',
                       help='verbose')
+    parser.add_option('--cache', metavar='FILE',
+                      help='keep harmonizations in an SQLite file, and '
+                           'reuse them on later runs')
+    parser.add_option('--cache-max-age', metavar='SECONDS', type='float',
+                      help='forget cached harmonizations older than this')
+    parser.add_option('--profile',
+                      action='store_true',
+                      help='profile the search, and print the hot spots '
+                           'and peak memory use to stderr')
+    parser.add_option('--profile-out', metavar='FILE',
+                      help='save the profile of the search, for pstats')
+    parser.add_option('--profile-limit', metavar='N', type='int', default=20,
+                      help='how many hot spots --profile prints '
+                           '[default: %default]')
+    parser.add_option('--batch', metavar='FILE',
+                      help='harmonize each line of FILE (- for stdin) as a '
+                           'melody, and write the results as JSON lines')
+    parser.add_option('--serve', metavar='ADDRESS',
+                      help='answer requests on a Unix socket (if ADDRESS '
+                           'is a path) or on HTTP (if it is [host:]port)')
+    parser.add_option('--workers', metavar='N', type='int',
+                      help='with --serve, the number of worker processes '
+                           '[default: one per CPU]')
+    parser.add_option('--timeout', metavar='SECONDS', type='float',
+                      default=600,
+                      help='with --serve, give up on a search after this '
+                           'long [default: %default]')
+    parser.add_option('--count',
+                      action='store_true',
+                      help='with --batch or --serve, only write the number '
+                           'of harmonizations')
+    parser.add_option('--top', metavar='N', type='int',
+                      help='with --batch or --serve, only write the N best '
+                           'harmonizations')
     opts,args = parser.parse_args()
     return (opts,args)
 